@@ -3,16 +3,45 @@ from runsuite import *
 
 class DriverTestMysql(DriverTestBase):
 	def test_invalid_db(self):
+		self.connect(database = self.options['_database'])
 		with self.assertRaises((AuthenticationError, IOError)):
-			self.connect(database = self.options['_database'])
+			self.db.conform()
 
 	def test_invalid_user(self):
+		self.connect(user = self.options['_user'])
 		with self.assertRaises(AuthenticationError):
-			self.connect(user = self.options['_user'])
+			self.db.conform()
 
 	def test_invalid_password(self):
+		self.connect(password = self.options['password'] + ' ')
 		with self.assertRaises(AuthenticationError):
-			self.connect(password = self.options['password'] + ' ')
+			self.db.conform()
+
+	def test_late_timeout(self):
+		from silk.webdb.drivers.mysql import statement
+		driver = self.db.__driver__
+		ended = statement(driver.connection.thread_id())
+		ended.end()
+		# A timer firing after its statement ended doesn't cancel the next,
+		# which SLEEP would show by returning 1
+		driver._kill_query(ended)
+		self.assertEqual(list(self.db.execute('SELECT SLEEP(0.2);')), [(0,)])
+
+	def test_aggregate_groupby(self):
+		self.db.define_table('orders', StrColumn('day', required=True), IntColumn('amount'))
+		orders = self.db.orders
+		orders.insert_many(dict(day='mon', amount=1), dict(day='mon', amount=2))
+		self.db.define_aggregate('totals', orders, groupby=orders.day, sums=orders.amount)
+		orders.insert(day='tue', amount=4)
+		self.assertEqual([tuple(row) for row in self.db.totals.select(orderby=self.db.totals.day)],
+			[('mon', 3, 2), ('tue', 4, 1)])
+
+	def test_aggregate_debug(self):
+		# Temporary tables can't have triggers
+		self.connect(debug=True)
+		self.db.define_table('orders', StrColumn('day', required=True), IntColumn('amount'))
+		with self.assertRaises(NotImplementedError):
+			self.db.define_aggregate('totals', self.db.orders, groupby=self.db.orders.day)
 
 if __name__=='__main__':
     try:
@@ -1,12 +1,25 @@
 #!/usr/bin/env python
 
 import configparser
+import gc
+import gzip
+import io
+import json
 import os
+import tempfile
 import unittest
+import weakref
 
 from silk.webdb import *
 import silk.webdb.drivers
 
+def summarize(rows):
+	"""Sums the values, days and note lengths of rows, for parallel_map,
+	whose workers are separate processes"""
+	rows = list(rows)
+	return (sum(row.value for row in rows), sum(row.created.day for row in rows),
+		sum(len(row.note) for row in rows))
+
 class DriverTestBase(unittest.TestCase):
 	def setUp(self):
 		self.connect()
@@ -16,6 +29,14 @@ class DriverTestBase(unittest.TestCase):
 		new.update(kwargs)
 		self.db = DB.connect(self.driver, **new)
 
+	def connect_shared(self):
+		"""Connects to a database which other connections can open too. A
+		database file is used instead of sqlite's in-memory default."""
+		try:
+			self.db.__driver__.clone().connection.close()
+		except ValueError:
+			self.connect(path=os.path.join(tempfile.mkdtemp(), 'shared.db'))
+
 	assertItemsEqual = unittest.TestCase.assertCountEqual
 
 class DriverTestConnection(DriverTestBase):
@@ -40,7 +61,55 @@ class DriverTestConnection(DriverTestBase):
 		with self.assertRaises(UnknownDriver):
 			DB.connect('base')
 
+	def test_retry(self):
+		driver = self.db.__driver__
+		driver.retry_delay = 0
+		calls = []
+		def flaky(failures):
+			calls.append(None)
+			if len(calls) <= failures:
+				raise TransientError('deadlock')
+			return len(calls)
+		self.assertEqual(self.db.retry(flaky, 2), 3)
+		self.assertEqual(driver.retry_stats, {'retries': 2, 'exhausted': 0})
+		del calls[:]
+		with self.assertRaises(TransientError):
+			self.db.retry(flaky, driver.retry_attempts)
+		self.assertEqual(driver.retry_stats['exhausted'], 1)
+		del calls[:]
+		with self.assertRaises(TransientError):
+			with self.db:
+				self.db.retry(flaky, 1)
+		self.assertEqual(len(calls), 1)
+
+	def test_retry_versioned_write(self):
+		self.db.define_table('versioned', StrColumn('data'), versioned=True)
+		driver = self.db.__driver__
+		driver.retry_delay = 0
+		execute = driver.execute
+		failures = ['deadlock']
+		def flaky(sql, values=()):
+			if sql.startswith('INSERT') and failures:
+				raise TransientError(failures.pop())
+			return execute(sql, values)
+		driver.execute = flaky
+		try:
+			self.db.versioned.insert(data='a')
+		finally:
+			del driver.execute
+		self.assertEqual(driver.retry_stats['retries'], 1)
+		self.assertEqual(list(self.db.versioned.select(self.db.versioned.data)), [('a',)])
+		self.assertEqual(self.db.versions('versioned'), {'versioned': 1})
+
 class DriverTestTableCreation(DriverTestBase):
+	def test_dropped_columns_collected(self):
+		self.db.define_table('table1', StrColumn('data'))
+		self.assertEqual(len(self.db.table1.data == 'a'), 0)
+		ref = weakref.ref(self.db.table1.data)
+		self.db.table1.drop()
+		gc.collect()
+		self.assertIsNone(ref())
+
 	def test_create_no_explicit_columns(self):
 		self.db.define_table('rowid_only')
 		self.assertEqual(len(self.db.rowid_only._columns), 1)
@@ -137,6 +206,224 @@ class DriverTestInsert(DriverTestBase):
 			self.db.table1[1]
 		self.assertEqual((self.db.table1.data=='abc').select().one().primarykey, ())
 
+	def test_upsert(self):
+		self.db.define_table('table1', StrColumn('key'), IntColumn('value'),
+			primarykey='key')
+		self.db.table1.upsert(key='a', value=1)
+		self.db.table1.upsert_many(
+			dict(key='a', value=2),
+			dict(key='b', value=3),
+			dict(key='c'))
+		self.assertEqual(list(map(tuple, self.db.table1.select(
+			orderby=self.db.table1.key))), [('a', 2), ('b', 3), ('c', None)])
+		with self.assertRaises(KeyError):
+			self.db.table1.upsert(value=4)
+
+	def test_insert_returning(self):
+		self.db.define_table('table1', StrColumn('data'),
+			IntColumn('value', default=5))
+		row = self.db.table1.insert_returning(data='a')
+		self.assertEqual((tuple(row), row.rowid), (('a', 5), 1))
+		self.db.__driver__.features.discard('returning')
+		row = self.db.table1.insert_returning(data='b', value=6)
+		self.assertEqual((tuple(row), row.rowid), (('b', 6), 2))
+
+	def test_import_csv(self):
+		self.db.define_table('table1', StrColumn('data', index=True),
+			DateTimeColumn('sent'))
+		source = io.StringIO('data,sent\r\na,2012-05-05 00:00:00\r\nb,\r\nc,2010-04-12 12:30:00\r\n')
+		self.assertEqual(self.db.table1.import_csv(source, chunk=2), 3)
+		self.assertEqual(list(map(tuple, self.db.table1.select())), [
+			('a', datetime.datetime(2012, 5, 5)),
+			('b', None),
+			('c', datetime.datetime(2010, 4, 12, 12, 30)),
+		])
+		self.assertIn(['data'], [columns for _, _, columns in self.db.__driver__._list_indexes('table1')])
+
+	def test_parallel_map(self):
+		self.connect_shared()
+		self.db.define_table('table1', IntColumn('value'), DateTimeColumn('created'),
+			StrColumn('note', compressed=True))
+		table1 = self.db.table1
+		table1.insert_many(*(dict(value=x, created=datetime.datetime(2026, 1, x + 1), note='x' * x)
+			for x in range(10)))
+		self.assertEqual(table1.parallel_map(summarize, partitions=3),
+			[(3, 6, 3), (12, 15, 12), (30, 34, 30)])
+		query = table1.value.belongs([1, 2, 8])
+		self.assertEqual(query.parallel_map(summarize, table1.value, table1.created, table1.note,
+			partitions=2), [(3, 5, 3), (8, 9, 8)])
+
+	def test_appender(self):
+		self.table1()
+		log = self.db.table1.appender(max_rows=10, max_delay=0)
+		log.append(data='a')
+		self.assertEqual((len(log), len(self.db.table1)), (0, 1))
+		log.max_delay = None
+		log.append(data='b')
+		self.assertEqual((len(log), len(self.db.table1)), (1, 1))
+		log.close()
+		self.assertEqual(len(self.db.table1), 2)
+		self.assertEqual(log.stats['flushes'], 2)
+
+	def test_deferred_column(self):
+		self.db.define_table('files', StrColumn('name'),
+			DataColumn('data', deferred=True), primarykey='name')
+		files = self.db.files
+		files.insert_many(dict(name='a', data=b'abc'), dict(name='b', data=b'x' * 10000))
+		rows = list(files.select(orderby=files.name))
+		self.assertEqual([tuple(row) for row in rows], [('a',), ('b',)])
+		self.assertNotIn('data', self.db.lastsql)
+		self.assertEqual(rows[1].data, b'x' * 10000)
+		self.db.__driver__.lastsql = None
+		self.assertEqual(rows[1].data, b'x' * 10000)
+		self.assertIsNone(self.db.lastsql)
+		self.assertEqual(rows[0].data, b'abc')
+		self.assertIsNone(self.db.lastsql)
+		self.assertEqual(files['a'].data, b'abc')
+		self.assertIn('data', self.db.lastsql)
+		with files.open_blob(files.data, 'b') as blob:
+			self.assertEqual([len(chunk) for chunk in iter(lambda: blob.read(4096), b'')], [4096, 4096, 1808])
+
+	def test_deferred_column_in_transaction(self):
+		self.db.define_table('files', StrColumn('name'),
+			DataColumn('data', deferred=True), primarykey='name')
+		files = self.db.files
+		names = ['%03i' % i for i in range(250)]
+		files.insert_many(*(dict(name=n, data=n.encode()) for n in names))
+		driver = self.db.__driver__
+		execute, statements = driver.execute, []
+		def counted(sql, values=()):
+			statements.append(sql)
+			return execute(sql, values)
+		driver.execute = counted
+		try:
+			with self.db:
+				data = [row.data for row in files.select(orderby=files.name)]
+		finally:
+			del driver.execute
+		self.assertEqual(data, [n.encode() for n in names])
+		self.assertEqual(len(statements), 4)
+
+	def test_compressed_column(self):
+		self.db.define_table('docs', StrColumn('name'), StrColumn('body', compressed=True),
+			DataColumn('data', compressed='lzma', deferred=True), primarykey='name')
+		docs = self.db.docs
+		docs.insert_many(dict(name='a', body='text ' * 1000, data=b'x' * 1000), dict(name='b', body='short'))
+		self.assertEqual(docs['a'].body, 'text ' * 1000)
+		self.assertEqual(docs['a'].data, b'x' * 1000)
+		self.assertEqual(docs['b'].body, 'short')
+		self.assertIsNone(docs['b'].data)
+		self.assertRaises(ValueError, docs.open_blob, docs.data, 'a')
+		stored = dict(self.db.__driver__.execute('SELECT name, body FROM docs;'))
+		self.assertLess(len(stored['a']), 100)
+		self.assertEqual(self.db.plan_migration(), [])
+		(docs.name == 'b').update(body='updated ' * 100)
+		self.assertEqual(docs['b'].body, 'updated ' * 100)
+		self.assertEqual(docs.update_many(['a'], dict(body='many ' * 100, data=b'y' * 1000)), 1)
+		self.assertEqual((docs['a'].body, docs['a'].data), ('many ' * 100, b'y' * 1000))
+		self.assertEqual(docs['b'].update(body='row').body, 'row')
+		stored = dict(self.db.__driver__.execute('SELECT name, body FROM docs;'))
+		self.assertLess(len(stored['a']), 100)
+		# Values stored before the column was compressed read unaltered
+		self.db.__driver__.execute("INSERT INTO docs (name, body) VALUES ('c', 'plain');")
+		self.assertEqual(docs['c'].body, 'plain')
+
+	def test_fulltext(self):
+		self.db.define_table('posts', StrColumn('title'), StrColumn('body'), fulltext=['title', 'body'])
+		posts = self.db.posts
+		posts.insert_many(dict(title='Foxes', body='brown foxes jump'), dict(title='Dogs', body='lazy dogs sleep'),
+			dict(title='More', body='quick brown foxes outrun other foxes'))
+		found = posts.body.match('foxes')
+		self.assertEqual(sorted(row.title for row in found.select()), ['Foxes', 'More'])
+		self.assertEqual([row.title for row in found.select(orderby=reversed(posts.body.relevance('foxes')))],
+			['More', 'Foxes'])
+		self.assertEqual([row.title for row in posts.title.match('foxes').select()], ['Foxes'])
+		(posts.title == 'Dogs').update(body='sleepy foxes')
+		(posts.title == 'More').delete()
+		self.assertEqual(sorted(row.title for row in found.select()), ['Dogs', 'Foxes'])
+		with self.assertRaises(ValueError):
+			posts.rowid.match('foxes')
+
+	def test_partitioned_table(self):
+		day = lambda d: datetime.datetime(2026, 1, d)
+		self.db.define_table('events', StrColumn('id'), DateTimeColumn('created'), IntColumn('value'),
+			primarykey='id', partition_by='created', interval='day')
+		events = self.db.events
+		events.insert_many(dict(id='a', created=day(1), value=1), dict(id='b', created=day(2), value=2),
+			dict(id='c', value=3))
+		events.insert(id='d', created=day(3), value=4)
+		self.assertEqual(events.import_csv(io.StringIO('id,created,value\ne,2026-01-02 12:00:00,5\n')), 1)
+		self.assertEqual(events.partitions(), [day(1), day(2), day(3)])
+		driver, calls = self.db.__driver__, []
+		list_tables = driver.list_tables
+		driver.list_tables = lambda: calls.append(1) or list_tables()
+		ids = lambda query: sorted(row.id for row in query.select())
+		self.assertEqual(ids(events), ['a', 'b', 'c', 'd', 'e'])
+		self.assertEqual(ids(events.created.between(day(2), day(2).replace(hour=23))), ['b', 'e'])
+		self.assertEqual(ids((day(2) < events.created) & (events.value > 0)), ['d', 'e'])
+		self.assertNotIn('events__20260101', self.db.lastsql)
+		self.assertEqual(calls, [])
+		del driver.list_tables
+		self.assertEqual(ids(events.created == None), ['c'])
+		self.assertEqual(events['d'].value, 4)
+		(events.created >= day(3)).update(value=0)
+		self.assertNotIn(' AS ', self.db.lastsql)
+		self.assertEqual(events.update_many(['a', 'c'], dict(value=-1)), 2)
+		(events.id == 'b').delete()
+		self.assertNotIn(' AS ', self.db.lastsql)
+		self.assertEqual([(row.id, row.value) for row in events.select(orderby=events.id)],
+			[('a', -1), ('c', -1), ('d', 0), ('e', 5)])
+		with self.assertRaises(ValueError):
+			(events.id == 'a').update(created=day(3))
+		self.assertEqual(events.drop_partitions(before=day(3)), 2)
+		self.assertEqual(ids(events), ['c', 'd'])
+		self.db.define_table('visits', StrColumn('id'), DateTimeColumn('created'), DateTimeColumn('updated'),
+			primarykey='id', partition_by='created', interval='day')
+		visits = self.db.visits
+		visits.insert_many(dict(id='a', created=day(1), updated=day(9)), dict(id='b', created=day(2), updated=day(10)),
+			dict(id='c', created=day(3), updated=day(4)))
+		self.assertEqual(ids(visits.updated > day(8)), ['a', 'b'])
+		self.assertEqual(ids(day(8) < visits.updated), ['a', 'b'])
+		(visits.updated > day(8)).delete()
+		self.assertEqual(ids(visits), ['c'])
+		visits.drop()
+		del self.db.events
+		self.db.define_table('events', StrColumn('id'), DateTimeColumn('created'), IntColumn('value'),
+			StrColumn('note'), primarykey='id', partition_by='created', interval='day')
+		self.assertEqual(self.db.plan_migration(), [('add_column', 'events', 'note'), ('add_column', 'events__20260103', 'note')])
+		self.db.migrate()
+		self.db.events.insert(id='f', created=day(3), note='new')
+		self.assertEqual(ids(self.db.events.note == 'new'), ['f'])
+		self.db.events.drop()
+		self.assertEqual(list(self.db.__driver__.list_tables()), [])
+
+	def test_aggregate(self):
+		self.db.define_table('orders', StrColumn('region'), StrColumn('day'), IntColumn('amount'), FloatColumn('tax'))
+		orders = self.db.orders
+		orders.insert_many(dict(region='n', day='mon', amount=1, tax=0.5), dict(region='s', day='mon', amount=2))
+		if not self.db.__driver__.null_primarykeys:
+			with self.assertRaises(ValueError):
+				self.db.define_aggregate('totals', orders, groupby=[orders.region, orders.day])
+			return
+		self.db.define_aggregate('totals', orders, groupby=[orders.region, orders.day], sums=[orders.amount, orders.tax])
+		self.db.define_aggregate('grand', orders, sums=orders.amount)
+		totals = self.db.totals
+		orders.insert_many(dict(region='n', day='mon', amount=4, tax=1.0), dict(region=None, day='tue', amount=8),
+			dict(region=None, day='tue', amount=16))
+		(orders.region == 's').update(region='n')
+		(orders.amount == 1).delete()
+		expected = [(None, 'tue', 24, 0.0, 2), ('n', 'mon', 6, 1.0, 2)]
+		self.assertEqual([tuple(row) for row in totals.select(orderby=[totals.region, totals.day])], expected)
+		self.assertEqual(totals['n', 'mon'].rows, 2)
+		self.assertEqual(self.db.grand.get(self.db.grand.amount), 30)
+		with self.db:
+			totals.delete()
+		totals.rebuild()
+		self.assertEqual([tuple(row) for row in totals.select(orderby=[totals.region, totals.day])], expected)
+		totals.drop()
+		orders.insert(region='e', day='wed', amount=1)
+		self.assertEqual(self.db.grand.get(self.db.grand.amount), 31)
+
 class DriverTestSelect(DriverTestBase):
 	def setUp(self):
 		DriverTestBase.setUp(self)
@@ -202,6 +489,110 @@ class DriverTestSelect(DriverTestBase):
 		self.assertEqual(self.db.users.select(self.db.users.age.average()).one()[0], 26.25)
 		self.assertEqual(self.db.users.select(self.db.users.age.max()).one()[0], 45)
 
+	def test_select_groupby(self):
+		users = self.db.users
+		self.assertEqual(list(map(tuple, users.select(
+			users.registered, users.age.sum(), users.age.tally(),
+			groupby=users.registered, orderby=users.registered))), [
+			(datetime.datetime(2010, 4, 12), 42, 2),
+			(datetime.datetime(2012, 5, 5), 18, 1),
+			(datetime.datetime(2012, 5, 6), 45, 1),
+		])
+		self.assertEqual([row.last_name for row in users.select(
+			users.last_name, groupby=users.last_name,
+			having=users.age.tally() > 1)], ['Smith'])
+		self.assertEqual(users.count(groupby=users.last_name), 3)
+
+	def test_select_belongs(self):
+		users = self.db.users
+		self.assertItemsEqual([row.first_name for row in
+			users.age.belongs([18, 19, 20]).select()], ['Maggie', 'Pat'])
+		self.assertEqual(len(users.age.belongs([])), 0)
+		self.assertEqual(len(~users.age.belongs([])), len(users))
+		self.assertNotIn('18', users.age.belongs([18, 19]).query().sql)
+		many = users.age.belongs(range(self.db.__driver__.max_parameters + 10))
+		self.assertEqual(len(many), len(users))
+		# Past max_parameters, values are written as literals of their type
+		self.db.define_table('blobs', DataColumn('data'), StrColumn('name'))
+		blobs = self.db.blobs
+		blobs.insert_many(dict(data=b"\x00'\xff", name="it's"), dict(data=b'abc', name='x\\y'))
+		self.db.__driver__.max_parameters = 3
+		values = [b'%i' % i for i in range(10)] + [b"\x00'\xff", b'abc']
+		self.assertEqual(len(blobs.data.belongs(values)), 2)
+		self.assertEqual(len(blobs.name.belongs(["it's", 'x\\y', 'a', 'b'])), 2)
+		del self.db.__driver__.max_parameters
+		self.assertItemsEqual([row.first_name for row in
+			users.age.belongs([18, 19, 20]).query(users.first_name)], ['Maggie', 'Pat'])
+		adults = users.age.belongs([18, 19, 20])
+		self.assertEqual(len(adults & (users.last_name.belongs(['x']) | adults)), 2)
+		self.db.define_table('admins', StrColumn('email'))
+		self.db.admins.insert(email='wgf@email.com')
+		self.assertEqual([row.first_name for row in users.email.belongs(
+			self.db.admins.subselect(self.db.admins.email)).select()],
+			['Werfina'])
+
+	def test_select_precedence(self):
+		users = self.db.users
+		self.assertEqual(len((users.age > 20) & ((users.last_name == 'Smith') |
+			(users.first_name == 'Maggie'))), 1)
+		self.assertEqual(len(~(users.age > 20) & (users.last_name == 'Smith')), 1)
+		self.assertEqual([r[0] for r in users.select(users.age - (users.age - -1),
+			orderby=users.email)], [-1, -1, -1, -1])
+
+	def test_select_long_condition(self):
+		users = self.db.users
+		condition = users.age != 0
+		for x in range(1, 3000):
+			condition = condition & (users.age != x)
+		self.assertEqual(len(condition), 0)
+
+	def test_select_limit(self):
+		self.assertEqual(len(list(self.db.users.select(limit=3))), 3)
+
+	def test_select_pages(self):
+		users = self.db.users
+		for orderby in (users.registered, reversed(users.registered),
+				[users.last_name, reversed(users.age)]):
+			rows = list(map(tuple, users.select(orderby=orderby)))
+			pages = list(users.pages(3, orderby=orderby))
+			self.assertEqual([len(page) for page in pages], [3, 1])
+			self.assertEqual([tuple(row) for page in pages for row in page], rows)
+
+	def test_select_query(self):
+		users = self.db.users
+		query = users.query(users.first_name).filter(users.last_name == 'Smith')
+		self.db.__driver__.lastsql = None
+		ordered = query.orderby(users.age)
+		self.assertIsNone(self.db.lastsql)
+		self.assertEqual([row.first_name for row in ordered], ['Pat', 'Bob'])
+		self.assertIs(ordered.sql, ordered.sql)
+		self.assertEqual(ordered.first().first_name, 'Pat')
+		self.assertEqual(query.count(), 2)
+		self.assertEqual(query.limit(1).count(), 1)
+		self.assertTrue(query.exists())
+		self.assertFalse(query.filter(users.age > 30).exists())
+
+	def test_select_exists(self):
+		users = self.db.users
+		self.assertTrue((users.age > 40).exists())
+		self.assertFalse((users.age > 50).exists())
+		self.assertEqual(users.get(users.age.max()), 45)
+		self.assertIn('LIMIT 1', self.db.lastsql)
+
+	def test_select_export(self):
+		users = self.db.users
+		query = users.last_name == 'Smith'
+		text = io.StringIO()
+		query.select(users.first_name, users.age, orderby=users.age).to_csv(text, size=1)
+		self.assertEqual(text.getvalue(), 'first_name,age\r\nPat,19\r\nBob,23\r\n')
+		data = io.BytesIO()
+		query.select(users.email, users.registered, orderby=users.age).to_jsonl(data, compress=True)
+		self.assertEqual([json.loads(line) for line in gzip.decompress(data.getvalue()).splitlines()], [
+			{'email': 'pat.smith@email.com', 'registered': '2010-04-12T00:00:00'},
+			{'email': 'bob.smith@email.com', 'registered': '2010-04-12T00:00:00'},
+		])
+		self.assertEqual(b''.join(users.select(users.age.sum()).stream()), b'column1\r\n105\r\n')
+
 	def test_select_complex_comparison(self):
 		self.assertItemsEqual(list(map(tuple, self.db.users.age.between(19,30).select())), [
 			('Bob', 'Smith', 'bob.smith@email.com', 23, datetime.datetime(2010, 4, 12, 0, 0)),
@@ -214,6 +605,21 @@ class DriverTestSelect(DriverTestBase):
 		self.assertEqual(record.update(age=record.age+1).age, 19)
 		self.assertEqual(self.db.users['magginator@email.com'].age, 19)
 
+	def test_update_many(self):
+		users = self.db.users
+		self.assertEqual(users.update_many(['bob.smith@email.com', 'wgf@email.com'], {'age': 30}, chunk=1), 2)
+		self.assertEqual(users.update_many(users.last_name == 'Smith', {'last_name': 'Jones'}, chunk=1), 2)
+		self.assertItemsEqual([(row.email, row.age) for row in (users.last_name == 'Jones').select()], [
+			('bob.smith@email.com', 30),
+			('pat.smith@email.com', 19),
+		])
+
+	def test_delete_many(self):
+		users = self.db.users
+		self.assertEqual(users.delete_many(users.age < 20, chunk=1), 2)
+		self.assertEqual(users.delete_many(['wgf@email.com', 'nobody@email.com']), 1)
+		self.assertEqual([row.email for row in users.select()], ['bob.smith@email.com'])
+
 	def test_record_bad_update(self):
 		record = self.db.users['magginator@email.com']
 		with self.assertRaises(KeyError):
@@ -328,6 +734,37 @@ class DriverTestReferences(DriverTestBase):
 		wm = self.db.addresses['webmaster', 'example.com']
 		self.assertEqual(tuple(wm.accounts.select().one()), ('webmaster@example.com', 'The Webmaster'))
 
+class DriverTestMigrate(DriverTestBase):
+	def setUp(self):
+		DriverTestBase.setUp(self)
+		self.db.define_table('table1', IntColumn('key'), StrColumn('name'))
+		for x in range(10):
+			self.db.table1.insert(key=x, name=str(x))
+		del self.db.table1
+
+	def test_add_column(self):
+		self.db.define_table('table1', IntColumn('key'), StrColumn('name'),
+			StrColumn('extra', index=True))
+		self.assertEqual(self.db.plan_migration(), [
+			('add_column', 'table1', 'extra'),
+			('add_index', 'table1', 'extra'),
+		])
+		self.db.migrate()
+		self.assertEqual(self.db.plan_migration(), [])
+		self.assertEqual(len(self.db.table1.extra == None), 10)
+
+	def test_rename_column(self):
+		self.db.define_table('table1', IntColumn('key'), StrColumn('title'))
+		self.db.migrate({'table1.title': 'name'})
+		self.assertEqual(self.db.table1[3].title, '2')
+
+	def test_change_type(self):
+		self.db.define_table('table1', StrColumn('key'), StrColumn('name'))
+		self.db.migrate(chunk=3)
+		self.assertEqual(self.db.plan_migration(), [])
+		self.assertEqual([row.key for row in self.db.table1.select(
+			orderby=self.db.table1.rowid)], list(map(str, range(10))))
+
 class DriverTestExceptions(DriverTestBase):
 	def test_sqlsyntaxerror(self):
 		self.db.__driver__.op_AND = lambda a,b:'%s AD %s'%(a,b)
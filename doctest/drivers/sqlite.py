@@ -1,10 +1,264 @@
 
 from runsuite import *
 
+import contextlib
+import io
+import tempfile
+import threading
+import time
+import weakref
+
 class DriverTestSqlite(DriverTestBase):
 	def test_invalid_path(self):
+		self.connect(path = 'path/to/false/database.sqlite')
 		with self.assertRaises(IOError):
-			self.connect(path = 'path/to/false/database.sqlite')
+			self.db.conform()
+
+	def test_snapshot_file(self):
+		self.db.define_table('table1', StrColumn('data'))
+		self.db.table1.insert(data='abc')
+		path = os.path.join(tempfile.mkdtemp(), 'snapshot.sqlite')
+		self.assertEqual(self.db.snapshot(path), path)
+		self.connect()
+		self.db.define_table('table1', StrColumn('data'))
+		self.db.restore(path)
+		self.assertEqual([row.data for row in self.db.table1.select()], ['abc'])
+		os.remove(path)
+
+	def test_single_writer(self):
+		path = os.path.join(tempfile.mkdtemp(), 'writer.sqlite')
+		self.connect(path=path, single_writer=True)
+		self.db.define_table('table1', IntColumn('thread'), IntColumn('value'))
+		def write(thread):
+			for value in range(50):
+				self.db.table1.insert(thread=thread, value=value)
+		threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(len(self.db.table1), 200)
+		self.assertEqual(self.db.table1.insert_returning(thread=9, value=9).rowid, 201)
+		with self.assertRaises(Exception):
+			self.db.execute('INSERT INTO nonexistent VALUES (1);')
+		self.assertEqual(self.db.table1.get(self.db.table1.value.sum()), 4 * sum(range(50)) + 9)
+		with self.assertRaises(ZeroDivisionError):
+			with self.db:
+				self.db.table1.insert(thread=10, value=1)
+				self.assertEqual(len(self.db.table1.thread == 10), 1)
+				1 / 0
+		self.assertEqual(len(self.db.table1.thread == 10), 0)
+		with self.db:
+			self.db.table1.insert(thread=10, value=1)
+			self.db.table1.insert(thread=10, value=2)
+		self.assertEqual(len(self.db.table1.thread == 10), 2)
+		self.db.__driver__.close()
+		os.remove(path)
+
+	def test_fork(self):
+		path = os.path.join(tempfile.mkdtemp(), 'fork.sqlite')
+		self.connect(path=path)
+		self.db.define_table('table1', StrColumn('data'))
+		self.db.table1.insert(data='parent')
+		pid = os.fork()
+		if pid == 0:
+			try:
+				self.db.table1.insert(data='child')
+			finally:
+				os._exit(0)
+		os.waitpid(pid, 0)
+		self.assertEqual([row.data for row in self.db.table1.select()], ['parent', 'child'])
+		os.remove(path)
+
+	def test_appender_delay(self):
+		path = os.path.join(tempfile.mkdtemp(), 'appender.sqlite')
+		self.connect(path=path)
+		self.db.define_table('table1', StrColumn('data'))
+		log = self.db.table1.appender(max_delay=0.05)
+		log.append(data='a')
+		self.assertEqual(len(log), 1)
+		for _ in range(100):
+			if not len(log):
+				break
+			time.sleep(0.05)
+		self.assertEqual((len(log), len(self.db.table1)), (0, 1))
+		ref = weakref.ref(log)
+		del log
+		self.assertIsNone(ref())
+		os.remove(path)
+
+	def test_appender_delay_partitioned(self):
+		path = os.path.join(tempfile.mkdtemp(), 'appender.sqlite')
+		self.connect(path=path)
+		self.db.define_table('events', StrColumn('id'), DateTimeColumn('created'),
+			primarykey='id', partition_by='created', interval='month')
+		events = self.db.events
+		def wait(log):
+			for _ in range(100):
+				if not len(log):
+					break
+				time.sleep(0.05)
+		log = events.appender(max_delay=0.05)
+		log.append(id='a', created=datetime.datetime(2026, 10, 18))
+		wait(log)
+		self.assertEqual(len(log), 0)
+		self.assertEqual(events.partitions(), [datetime.datetime(2026, 10, 1)])
+		self.assertEqual([row.id for row in events.select()], ['a'])
+		# Rows the timer fails to insert are kept for the next flush
+		log.append(id='b', missing=1)
+		errors = io.StringIO()
+		with contextlib.redirect_stderr(errors):
+			time.sleep(0.3)
+		self.assertEqual(len(log), 1)
+		self.assertIn('missing', errors.getvalue())
+		log._rows[0].pop('missing')
+		log.close()
+		self.assertEqual(sorted(row.id for row in events.select()), ['a', 'b'])
+		os.remove(path)
+
+	def test_statement_timeout(self):
+		self.db.define_table('table1', IntColumn('value'))
+		self.db.table1.insert_many(*(dict(value=i) for i in range(2000)))
+		total = self.db.table1.value.sum()
+		with self.assertRaises(StatementTimeout):
+			self.db.table1.select(total, timeout=0)
+		self.assertEqual(self.db.table1.get(total, timeout=10), sum(range(2000)))
+		with self.assertRaises(StatementTimeout):
+			list(self.db.table1.select(self.db.table1.value, timeout=0))
+		self.assertEqual(len(list(self.db.table1.select(self.db.table1.value, timeout=10))), 2000)
+		self.db.__driver__.statement_timeout = 0
+		with self.assertRaises(StatementTimeout):
+			self.db.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i+1 FROM n) SELECT count(*) FROM n;')
+
+	def test_statement_timeout_streams(self):
+		self.db.__driver__.statement_timeout = 0.5
+		rows = self.db.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i+1 FROM n) SELECT i FROM n;')
+		# Rows are read as they're needed, and reading them is interrupted
+		self.assertEqual(rows.fetchmany(3), [(1,), (2,), (3,)])
+		with self.assertRaises(StatementTimeout):
+			for row in rows:
+				pass
+
+	def test_fulltext_schema(self):
+		self.db.define_table('posts', StrColumn('body'), fulltext=['body'])
+		self.db.posts.insert(body='brown foxes')
+		self.assertEqual(sorted(self.db.__driver__.list_tables()), ['posts'])
+		self.db.define_table('posts_fts_archive', StrColumn('body'))
+		self.db.execute('CREATE VIRTUAL TABLE notes USING fts5(body);')
+		self.assertEqual(sorted(self.db.__driver__.list_tables())[:3], ['notes', 'notes_config', 'notes_content'])
+		self.assertIn('posts_fts_archive', self.db.__driver__.list_tables())
+		self.db.execute('DROP TABLE notes;')
+		self.db.posts_fts_archive.drop()
+		del self.db.posts
+		self.db.define_table('posts', StrColumn('body', required=True), IntColumn('votes'), fulltext=['body'])
+		self.assertEqual(self.db.plan_migration(), [('rebuild_table', 'posts')])
+		self.db.migrate()
+		posts = self.db.posts
+		posts.insert(body='lazy foxes', votes=1)
+		self.assertEqual(len(list(posts.body.match('foxes').select())), 2)
+		posts.drop()
+		self.assertEqual(list(self.db.__driver__.list_tables()), [])
+
+	def test_rebuild_keeps_changes(self):
+		for primarykey in (None, 'key'):
+			self.connect()
+			self.db.define_table('table1', IntColumn('key'), StrColumn('name'), primarykey=primarykey)
+			self.db.table1.insert_many(*(dict(key=x, name=str(x)) for x in range(1, 11)))
+			del self.db.table1
+			self.db.define_table('table1', IntColumn('key'), IntColumn('name'), primarykey=primarykey)
+			driver = self.db.__driver__
+			execute, chunks = driver.execute, []
+			def changing(sql, values=()):
+				cursor = execute(sql, values)
+				if sql.startswith('INSERT INTO "table1__rebuild"') and not chunks:
+					# Changes made by other writers once the first chunk is copied
+					chunks.append(sql)
+					execute("UPDATE table1 SET name = '-2' WHERE key = 2;")
+					execute("UPDATE table1 SET key = 20 WHERE key = 3;")
+					execute('DELETE FROM table1 WHERE key = 4;')
+					execute("INSERT INTO table1 (key, name) VALUES (11, '11');")
+				return cursor
+			driver.execute = changing
+			self.db.migrate(chunk=5)
+			del driver.execute
+			table1 = self.db.table1
+			self.assertEqual([(row.key, row.name) for row in table1.select(orderby=table1.key)],
+				[(1, 1), (2, -2)] + [(x, x) for x in range(5, 12)] + [(20, 3)])
+			self.assertEqual(sorted(driver.list_tables()), ['table1'])
+
+	def test_rebuild_failure_cleans_up(self):
+		self.db.define_table('table1', IntColumn('key'), StrColumn('name'))
+		self.db.table1.insert_many(dict(key=1, name='a'), dict(key=2))
+		del self.db.table1
+		self.db.define_table('table1', IntColumn('key'), StrColumn('name', required=True))
+		self.assertEqual(self.db.plan_migration(), [('rebuild_table', 'table1')])
+		with self.assertRaises(Exception):
+			self.db.migrate(chunk=1)
+		driver = self.db.__driver__
+		self.assertEqual(sorted(driver.list_tables()), ['table1'])
+		self.assertEqual(driver.execute("SELECT name FROM sqlite_master WHERE type='trigger';").fetchall(), [])
+		driver.execute("INSERT INTO table1 (key, name) VALUES (3, 'c');")
+		self.assertEqual(driver.execute('SELECT count(*) FROM table1;').fetchone(), (3,))
+
+	def test_versions_across_connections(self):
+		path = os.path.join(tempfile.mkdtemp(), 'versions.sqlite')
+		self.connect(path=path)
+		self.db.define_table('table1', StrColumn('data'), versioned=True)
+		self.db.define_table('table2', StrColumn('data'), versioned=True)
+		seen = self.db.versions()
+		other = DB.connect('sqlite', path=path)
+		other.define_table('table1', StrColumn('data'), versioned=True)
+		other.table1.insert_many(dict(data='abc'), dict(data='def'))
+		other.table1.update(data='ghi')
+		self.assertEqual(len(other.table1.data == 'ghi'), 2)
+		current = self.db.versions()
+		self.assertEqual({name for name in current if current[name] != seen[name]}, {'table1'})
+		self.assertEqual(current['table1'], seen['table1'] + 2)
+		with self.assertRaises(ZeroDivisionError):
+			with other:
+				other.table1.delete()
+				1 / 0
+		self.assertEqual(self.db.versions(), current)
+		self.db.table1.drop()
+		self.assertEqual(other.versions('table1'), {'table1': 2})
+		os.remove(path)
+
+	def test_sharded(self):
+		directory = tempfile.mkdtemp()
+		shards = [DB.connect('sqlite', path=os.path.join(directory, 'shard%i.sqlite' % i)) for i in range(3)]
+		self.db = DB.connect('sharded', shards)
+		self.db.define_table('table1', IntColumn('user', primarykey=True), IntColumn('item', primarykey=True), StrColumn('data'), shard_key='user')
+		self.db.define_table('table2', StrColumn('data'))
+		t = self.db.table1
+		t.insert_many(*(dict(user=u, item=i, data='%i-%i' % (u, i)) for u in range(10) for i in range(3)))
+		counts = [shard.execute('SELECT count(*) FROM table1;').fetchone()[0] for shard in shards]
+		self.assertEqual(sum(counts), 30)
+		self.assertTrue(all(counts))
+		self.assertEqual(t[7, 2].data, '7-2')
+		self.assertEqual(t.count(), 30)
+		self.assertEqual([(row.user, row.item) for row in t.select(orderby=(reversed(t.user), t.item), limit=4)], [(9, 0), (9, 1), (9, 2), (8, 0)])
+		self.assertEqual([row.user for row in t.select(t.user, distinct=True, orderby=t.user)], list(range(10)))
+		self.assertEqual(list(map(tuple, t.select(t.item, t.user.tally(), t.user.max(), groupby=t.item, orderby=t.item))), [(i, 10, 9) for i in range(3)])
+		self.assertEqual([row.data for row in t.query().filter(t.item == 1).orderby(t.user).limit(2)], ['0-1', '1-1'])
+		(t.user == 3).update(data='three')
+		self.assertEqual(sorted({row.data for row in (t.user == 3).select()}), ['three'])
+		(t.user.belongs([1, 2])).delete()
+		self.assertEqual(t.count(), 24)
+		self.assertRaises(ValueError, (t.user == 4).update, user=5)
+		self.assertRaises(NotImplementedError, t.select, t.item.average())
+		self.assertRaises(NotImplementedError, t.select, t.item.max() - t.item.min())
+		self.assertRaises(NotImplementedError, t.select, t.user, groupby=t.user, orderby=reversed(t.item.sum() * 2))
+		self.assertEqual(list(map(tuple, t.select(t.item.max(), t.item.min()))), [(2, 0)])
+		self.db.table2.insert(data='abc')
+		self.assertEqual([shard.execute('SELECT count(*) FROM table2;').fetchone()[0] for shard in shards], [1, 0, 0])
+		self.assertRaises(ValueError, self.db.execute, "INSERT INTO table2(data) VALUES ('def');")
+		self.db.execute("INSERT INTO table2(data) VALUES ('def');", shard=0)
+		self.assertEqual(sorted(row.data for row in self.db.table2.select()), ['abc', 'def'])
+		self.assertEqual(sum(n for n, in self.db.execute('SELECT count(*) FROM table1;')), 24)
+		self.assertRaises(AttributeError, getattr, self.db.__driver__, 'connection')
+		self.assertRaises(ValueError, self.db.define_table, 'table3', IntColumn('key'), StrColumn('data'), shard_key='data')
+		for shard in shards:
+			os.remove(shard.__driver__.path)
 
 if __name__=='__main__':
 	main('sqlite')
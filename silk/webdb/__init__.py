@@ -4,8 +4,10 @@ webdb is a database abstraction layer inspired by web2py's DAL. The goal
 of webdb is to be more succinct and offer better cross-table integration.
 
 
-Use the connect method to open a database connection.
->>> mydb = DB.connect('sqlite','path/to/database.sqlite')  # doctest: +ELLIPSIS
+Use the connect method to open a database connection. The connection is
+opened when it's first used, and reopened by processes forked after that.
+>>> mydb = DB.connect('sqlite','path/to/database.sqlite')
+>>> mydb.conform()  # doctest: +ELLIPSIS
 Traceback (most recent call last):
  ...
 FileNotFoundError: ... No such file or directory: 'path/to/database.sqlite'
@@ -51,7 +53,7 @@ Migrate modifies tables in the database to be like newly-assigned tables.
 >>> mydb.test_table.drop()
 >>> mydb.define_table('test_table', IntColumn('key'), StrColumn('value'),
 ...                   StrColumn('extra'))
->>> #mydb.migrate()
+>>> mydb.migrate()
 >>> mydb.test_table
 <Table 'test_table'>
 
@@ -223,9 +225,26 @@ Remove tables by calling 'drop' on them.
 >>> mydb.test_table.drop()
 """
 
+import atexit
+import base64
+import collections
+import concurrent.futures
 import copy
+import csv
 import datetime
+import functools
+import io
+import itertools
+import json
+import lzma
+import multiprocessing
+import os
 import sys
+import threading
+import time
+import traceback
+import weakref
+import zlib
 
 from . import drivers
 
@@ -239,8 +258,11 @@ class RecordError(Exception):
 
 AuthenticationError = drivers.base.AuthenticationError
 SQLSyntaxError = drivers.base.SQLSyntaxError
+TransientError = drivers.base.TransientError
+StatementTimeout = drivers.base.StatementTimeout
 
-__all__ = ['RecordError', 'AuthenticationError', 'SQLSyntaxError', 'datetime']
+__all__ = ['RecordError', 'AuthenticationError', 'SQLSyntaxError',
+           'TransientError', 'StatementTimeout', 'datetime']
 
 
 class __Row__(tuple):
@@ -277,7 +299,11 @@ class __Row__(tuple):
         try:
             return tuple.__getitem__(self, key)
         except TypeError:
-            return tuple.__getitem__(self, self._selection.index(key))
+            try:
+                index = self._selection.index(key)
+            except KeyError:
+                return self._selection._deferred_value(key, self.primarykey)
+            return tuple.__getitem__(self, index)
     __getattr__ = __getitem__
 
     def __eq__(self, x):
@@ -292,6 +318,56 @@ class __Row__(tuple):
             zip(self._selection.explicit, self))
 
 
+def _convert(column, value):
+    if value is None:
+        return value
+    if column.fromdb:
+        value = column.fromdb(value)
+    return (value if isinstance(value, column.native_type) else
+            column.native_type(value))
+
+
+def _converter(column):
+    """Precompiled ``_convert`` for a single column"""
+    fromdb, native_type = column.fromdb, column.native_type
+
+    def convert(value):
+        if value is None:
+            return value
+        if fromdb:
+            value = fromdb(value)
+        return value if isinstance(value, native_type) else native_type(value)
+    return convert
+
+
+def _encode(chunks, compress, encoding='utf-8'):
+    """Encodes text ``chunks``, gzip compressed if ``compress``"""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    for chunk in chunks:
+        chunk = chunk.encode(encoding)
+        if compressor:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+def _text_converter(column):
+    """Parses text into ``column``'s native type"""
+    if column.native_type is bool:
+        return lambda value: value.lower() in ('1', 't', 'true', 'y', 'yes')
+    return _converter(column)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
 class Selection(object):
     def __init__(self, columns, explicit, primarykey, values):
         refs = {'__slots__': (), '_selection': self}
@@ -309,6 +385,18 @@ class Selection(object):
         self.values = values
         self.Row = type('Row', (__Row__,), refs)
         self.cache = None
+        # Rows of tables with deferred columns are read ahead in batches,
+        # whose deferred values are then read together
+        self._read_ahead = bool(primarykey) and any(
+            c.deferred for c in primarykey[0].table.ALL)
+        self._ahead = collections.deque()
+        # Primary keys of the batch read last, and the deferred values of
+        # its rows read so far, by column name
+        self._batch = []
+        self._deferred = {}
+
+    # Rows read ahead at a time, see ``_read_ahead``
+    batch_size = 100
 
     def index(self, name):
         return self.names[name]
@@ -321,18 +409,140 @@ class Selection(object):
             value = self.cache
             self.cache = None
         else:
-            value = self.values.fetchone()
+            value = self._fetchone()
         if value is None:
             raise StopIteration
-
-        def conv(c, v):
-            if v is None:
-                return v
-            if c.fromdb:
-                v = c.fromdb(v)
-            return v if isinstance(v, c.native_type) else c.native_type(v)
-
-        return self.Row(map(conv, self.columns, value))
+        return self._make_row(value)
+
+    def _fetchone(self):
+        if self._ahead:
+            return self._ahead.popleft()
+        if not self._read_ahead:
+            return self.values.fetchone()
+        rows = self.values.fetchmany(self.batch_size)
+        if not rows:
+            return None
+        self._ahead.extend(rows)
+        self._batch = [tuple(_convert(c, row[self.names[c.name]])
+                             for c in self.primarykey) for row in rows]
+        self._deferred = {}
+        return self._ahead.popleft()
+
+    def _deferred_value(self, name, key):
+        """Value of the deferred column ``name`` in the row with primary
+        key ``key``. The values of every row in the batch read last are
+        selected at once, and only kept until the next batch is read, so
+        that reading the values of many rows doesn't keep them all."""
+        if not self.primarykey:
+            raise KeyError(name)
+        table = self.primarykey[0].table
+        column = table._columns.get(name)
+        if column is None or not column.deferred:
+            raise KeyError(name)
+        values = self._deferred.get(name)
+        if values is None or key not in values:
+            keys = self._batch if key in self._batch else [key]
+            values = self._deferred[name] = self._deferred_values(
+                table, column, keys)
+        return values.get(key)
+
+    def _deferred_values(self, table, column, keys):
+        """Values of ``column`` in the rows of ``table`` with primary keys
+        ``keys``, as a dict, selected by one query"""
+        primarykey = table.primarykey
+        if len(primarykey) == 1:
+            query = primarykey[0].belongs(key[0] for key in keys)
+        else:
+            query = reduce(lambda x, y: x | y, map(table._by_pk, keys))
+        # A cursor of its own, which doesn't lose the rows left to read of
+        # a selection in the same transaction
+        with table._db.__driver__._apart():
+            return {row.primarykey: row[0]
+                    for row in query.select(column, *primarykey)}
+
+    def _make_row(self, value):
+        return self.Row(map(_convert, self.columns, value))
+
+    def _batches(self, size):
+        """Lists of about ``size`` rows of converted values, without
+        creating Row objects"""
+        converters = [_converter(c) for c in self.explicit]
+        count = len(converters)
+        while True:
+            values = self.values.fetchmany(size)
+            if self._ahead:
+                values[:0] = self._ahead
+                self._ahead.clear()
+            if self.cache:
+                values.insert(0, self.cache)
+                self.cache = None
+            if not values:
+                return
+            yield [[conv(v) for conv, v in zip(converters, value[:count])]
+                   for value in values]
+
+    def _names(self):
+        return [getattr(c, 'name', None) or 'column%i' % (i + 1)
+                for i, c in enumerate(self.explicit)]
+
+    def iter_csv(self, size=1000, header=True):
+        """Iterates through CSV formatted text, ``size`` rows at a time"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(self._names())
+        for batch in self._batches(size):
+            writer.writerows(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    def iter_jsonl(self, size=1000):
+        """Iterates through JSON objects, one per line, ``size`` rows at a
+        time"""
+        names = self._names()
+        for batch in self._batches(size):
+            yield ''.join(
+                json.dumps(dict(zip(names, row)), default=_json_default) +
+                '\n' for row in batch)
+
+    def stream(self, format='csv', compress=False, size=1000,
+               encoding='utf-8'):
+        """Iterates through the rows formatted as ``'csv'`` or ``'jsonl'``
+        and encoded as bytes, optionally gzip compressed. Suitable as a WSGI
+        response body, e.g. as the content returned by a router.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_stream', StrColumn('name'),
+        ...                   IntColumn('value'))
+        >>> mydb.test_stream.insert_many(dict(name='a', value=1),
+        ...                              dict(name='b', value=2))
+        >>> b''.join(mydb.test_stream.select().stream())
+        b'name,value\\r\\na,1\\r\\nb,2\\r\\n'
+        >>> import gzip
+        >>> gzip.decompress(b''.join(mydb.test_stream.select().stream(
+        ...   'jsonl', compress=True)))
+        b'{"name": "a", "value": 1}\\n{"name": "b", "value": 2}\\n'
+        """
+        chunks = {'csv': self.iter_csv, 'jsonl': self.iter_jsonl}[format](
+            size)
+        return _encode(chunks, compress, encoding)
+
+    def to_csv(self, fileobj, compress=False, size=1000, header=True):
+        """Writes the rows to ``fileobj`` as CSV, ``size`` rows at a time.
+        ``fileobj`` must be opened in text mode with ``newline=''``, or in
+        binary mode when compressing."""
+        chunks = self.iter_csv(size, header)
+        for chunk in _encode(chunks, True) if compress else chunks:
+            fileobj.write(chunk)
+
+    def to_jsonl(self, fileobj, compress=False, size=1000):
+        """Writes the rows to ``fileobj`` as JSON lines. See ``to_csv``."""
+        chunks = self.iter_jsonl(size)
+        for chunk in _encode(chunks, True) if compress else chunks:
+            fileobj.write(chunk)
 
     def one(self):
         try:
@@ -350,7 +560,7 @@ class Selection(object):
 
     def skip(self, count):
         for x in range(count):
-            self.values.fetchone()
+            self._fetchone()
 
     def __getitem__(self, x):
         if not isinstance(x, slice):
@@ -367,60 +577,580 @@ class Selection(object):
 
     def __bool__(self):
         if not self.cache:
-            self.cache = self.values.fetchone()
+            self.cache = self._fetchone()
         return self.cache is not None
 
 
+def _process_pool(workers):
+    # Spawned, since forking while other threads (like sqlite's writer)
+    # hold locks can leave the children waiting on them forever
+    return concurrent.futures.ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def _detached(columns):
+    """Copies of ``columns`` which only convert values, without the table
+    or database they belong to, so they can be sent to other processes"""
+    return [Column(getattr(c, 'name', None), c.native_type, fromdb=c.fromdb)
+            for c in columns]
+
+
+def _scan_partition(func, driver, sql, values, columns, explicit):
+    """Calls ``func`` with the rows of one partition of ``parallel_map``.
+    Everything needed is passed in, so it can run in a spawned process."""
+    driver = driver.clone()
+    try:
+        return func(Selection(columns, explicit, [],
+                              driver.execute(sql, values)))
+    finally:
+        driver.connection.close()
+
+
 class Selectable(object):
     def _get_columns(self, columns):
         if not columns:
-            columns = [table.ALL for table in self._tables]
+            columns = [table._selected for table in self._tables]
         return flatten(columns)
 
     def select(self, *columns, **props):
+        """Selects ``columns`` (by default, all columns of every table
+        involved) from rows matching this query.
+
+        :``distinct=False``: Omit duplicate rows.
+        :``orderby=()``: Expression or list of expressions to sort by.
+        :``groupby=()``: Expression or list of expressions. Rows with
+          equal values are combined into one, so other columns should be
+          aggregates.
+        :``having=None``: Condition on the combined rows of ``groupby``.
+        :``limit=None``: Maximum number of rows to select.
+        :``timeout=None``: Seconds after which running the query is
+          cancelled, raising ``StatementTimeout``. By default, the
+          driver's ``statement_timeout`` applies. sqlite runs queries as
+          their rows are read, so reading them counts as running the
+          query.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_groupby', StrColumn('name'),
+        ...                   IntColumn('value'))
+        >>> mydb.test_groupby.insert_many(
+        ...   dict(name='a', value=1), dict(name='a', value=2),
+        ...   dict(name='b', value=4))
+        >>> t = mydb.test_groupby
+        >>> for row in t.select(t.name, t.value.sum(), t.value.tally(),
+        ...                     groupby=t.name, orderby=t.name):
+        ...   print(tuple(row))
+        ('a', 3, 2)
+        ('b', 4, 1)
+        >>> for row in t.select(t.name, groupby=t.name,
+        ...                     having=t.value.sum() > 3):
+        ...   print(row.name)
+        b
+        """
+        all_columns, columns, primarykey, args = self._select_args(
+            columns, props)
+        driver = self._db.__driver__
+        with driver.time_limit(props.get('timeout')):
+            values = driver._select(*args)
+        return Selection(all_columns, columns, primarykey, values)
+
+    def _select_args(self, columns, props):
+        """Columns of the ``Selection`` and arguments for the driver's
+        ``_select``"""
         columns = self._get_columns(columns)
         all_columns = columns[:]
         primarykey = []
+        groupby = sequence(props.get('groupby', ()))
         if not self._tables:
             raise Exception('No tables! Using %s' % flatten(columns))
-        elif len(self._tables) == 1 and not props.get('distinct'):
+        elif (len(self._tables) == 1 and not props.get('distinct') and
+                not groupby):
             primarykey = self._tables.copy().pop().primarykey
             all_columns.extend(primarykey)
-        values = self._db.__driver__._select(
+        return all_columns, columns, primarykey, (
             all_columns,
             self._tables,
             self._where_tree,
             props.get('distinct', False),
-            sequence(props.get('orderby', ()))
+            sequence(props.get('orderby', ())),
+            groupby,
+            props.get('having'),
+            props.get('limit'),
         )
-        return Selection(all_columns, columns, primarykey, values)
+
+    def parallel_map(self, func, *columns, **props):
+        """Splits the rows of a single table into ``partitions`` ranges of
+        its primary key and calls ``func`` with the rows of each range in a
+        separate worker. Returns the results in order of primary key.
+
+        ``executor`` is called with the number of partitions and must
+        return a ``concurrent.futures`` executor. By default, a pool of
+        spawned processes is used, so ``func`` and its results must be
+        picklable, e.g. ``func`` is a function defined at the top level of
+        a module. Each worker opens its own connection, so the database
+        can't be in memory, and uncommitted changes aren't seen. Rows
+        given to ``func`` only hold the values selected: they don't follow
+        references or read deferred columns. The primary key must be a
+        single integer column.
+
+        Other keyword arguments are passed to ``select``.
+
+        >>> import concurrent.futures, os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'parallel.sqlite')
+        >>> mydb = DB.connect('sqlite', path)
+        >>> mydb.define_table('test_parallel', IntColumn('value'))
+        >>> mydb.test_parallel.insert_many(*(dict(value=x) for x in range(10)))
+        >>> t = mydb.test_parallel
+        >>> t.parallel_map(lambda rows: sum(r.value for r in rows),
+        ...     partitions=3, executor=concurrent.futures.ThreadPoolExecutor)
+        [3, 12, 30]
+        >>> (t.value > 4).parallel_map(lambda rows: len(list(rows)),
+        ...     partitions=2, executor=concurrent.futures.ThreadPoolExecutor)
+        [2, 3]
+        """
+        partitions = props.pop('partitions', None) or os.cpu_count() or 1
+        executor = props.pop('executor', _process_pool)
+        if len(self._tables) != 1:
+            raise TypeError('Can only partition rows of a single table')
+        table, = self._tables
+        if (len(table.primarykey) != 1 or
+                table.primarykey[0].native_type is not int):
+            raise TypeError('Can only partition tables with a single integer'
+                            ' primary key')
+        key, = table.primarykey
+        driver = self._db.__driver__
+        low, high = driver._select([key.min(), key.max()], self._tables,
+                                   self._where_tree, False, ()).fetchone()
+        if low is None:
+            return []
+        step = (high - low + 1) / partitions
+        bounds = sorted({low + int(step * i) for i in range(1, partitions)})
+        bounds = [None] + [b for b in bounds if b > low] + [None]
+        queries = []
+        for start, stop in zip(bounds, bounds[1:]):
+            condition = None
+            if start is not None:
+                condition = key >= start
+            if stop is not None:
+                condition = (key < stop if condition is None else
+                             condition & (key < stop))
+            query = self if condition is None else self._refine(condition)
+            all_columns, names, primarykey, args = query._select_args(
+                columns, props)
+            values = []
+            sql = driver.select_sql(*driver._select_args(
+                *args, parameters=values))
+            detached = _detached(all_columns)
+            queries.append((sql, values, detached, detached[:len(names)]))
+        with executor(len(queries)) as pool:
+            futures = [pool.submit(_scan_partition, func, driver, *query)
+                       for query in queries]
+            return [future.result() for future in futures]
+
+    def _refine(self, condition):
+        """Query for rows matching both this query and ``condition``"""
+        if not self._where_tree:
+            return condition
+        return Where(condition, drivers.base.AND, self, condition)
+
+    def _keyset(self, orderby):
+        """Pairs of (column, descending) which order rows uniquely"""
+        keyset = []
+        for order in sequence(orderby):
+            tree = getattr(order, '_where_tree', None)
+            descending = (tree is not None and
+                          tree[0] == drivers.base.DESCEND)
+            if tree is not None and tree[0] in (drivers.base.DESCEND,
+                                                drivers.base.ASCEND):
+                order = tree[1]
+            if not isinstance(order, Column):
+                raise TypeError('Can only page through rows ordered by'
+                                ' columns, not %r' % order)
+            keyset.append((order, descending))
+        for table in self._tables:
+            for column in table.primarykey:
+                if not any(c is column for c, _ in keyset):
+                    keyset.append((column, False))
+        return keyset
+
+    def page_after(self, last_row, *columns, **props):
+        """Selects the ``size`` rows which follow ``last_row`` in the order
+        given by ``orderby``.
+
+        Unlike skipping rows with an offset, the database seeks directly to
+        the next page, using a condition like ``(a, key) > (1, 2)``.
+        Primary keys are appended to ``orderby`` so that rows are ordered
+        uniquely. ``last_row`` must include the ``orderby`` columns, and
+        pages are only consistent if those columns don't contain NULL. If
+        ``last_row`` is None, the first page is selected.
+
+        Other keyword arguments are passed to ``select``.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_pages', IntColumn('value'))
+        >>> mydb.test_pages.insert_many(*(dict(value=x % 3) for x in range(7)))
+        >>> t = mydb.test_pages
+        >>> page = list(t.page_after(None, orderby=t.value, size=3))
+        >>> page
+        [Row(value=0), Row(value=0), Row(value=0)]
+        >>> list(t.page_after(page[-1], orderby=t.value, size=3))
+        [Row(value=1), Row(value=1), Row(value=2)]
+        >>> mydb.lastsql  # doctest: +NORMALIZE_WHITESPACE
+        'SELECT "test_pages"."value", "test_pages"."rowid" FROM "test_pages"
+         WHERE ("test_pages"."value", "test_pages"."rowid")>(0, 7)
+         ORDER BY "test_pages"."value", "test_pages"."rowid" LIMIT 3;'
+        """
+        keyset = self._keyset(props.pop('orderby', ()))
+        props['orderby'] = [reversed(c) if d else c for c, d in keyset]
+        props['limit'] = props.pop('size', 100)
+        query = self
+        if last_row is not None:
+            query = self._refine(self._seek(keyset, [
+                last_row[column.name] for column, _ in keyset]))
+        return query.select(*columns, **props)
+
+    def _seek(self, keyset, values):
+        """Condition selecting rows after ``values`` in ``keyset`` order"""
+        column = keyset[0][0]
+        if len({d for _, d in keyset}) == 1:
+            return Where(column,
+                         drivers.base.LESSTHAN if keyset[0][1] else
+                         drivers.base.GREATERTHAN,
+                         [drivers.base.ROW] + [c for c, _ in keyset],
+                         [drivers.base.ROW] + values)
+        # Row values can only be compared in one direction
+        condition = None
+        for i, (column, descending) in enumerate(keyset):
+            term = column < values[i] if descending else column > values[i]
+            for previous, value in zip(keyset[:i], values):
+                term = (previous[0] == value) & term
+            condition = term if condition is None else condition | term
+        return condition
+
+    def pages(self, size, *columns, **props):
+        """Iterates through lists of at most ``size`` rows. See
+        ``page_after``."""
+        last_row = None
+        while True:
+            page = list(self.page_after(last_row, *columns, size=size,
+                                        **props))
+            if page:
+                yield page
+            if len(page) < size:
+                return
+            last_row = page[-1]
 
     def select1(self, *columns, **props):
+        props.setdefault('limit', 1)
         return self.select(*columns, **props).one()
 
     def get(self, expression, **props):
+        props.setdefault('limit', 1)
         return self.select(expression, **props).one()[0]
 
+    def exists(self):
+        """Whether any rows match, without selecting them
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_exists', IntColumn('value'))
+        >>> t = mydb.test_exists
+        >>> t.insert(value=1)
+        >>> (t.value == 1).exists()
+        True
+        >>> mydb.lastsql
+        'SELECT 1 FROM "test_exists" WHERE "test_exists"."value" = 1 LIMIT 1;'
+        >>> (t.value == 2).exists()
+        False
+        """
+        return self._db.__driver__._select(
+            [1], self._tables, self._where_tree, False, (), limit=1,
+        ).fetchone() is not None
+
     def count(self, **props):
-        columns = flatten(table.primarykey for table in self._tables)
+        groupby = sequence(props.get('groupby', ()))
+        columns = groupby or flatten(
+            table.primarykey for table in self._tables)
         values = self._db.__driver__._select(
             columns,
             self._tables,
             self._where_tree,
             props.get('distinct', False),
-            sequence(props.get('orderby', ()))
+            sequence(props.get('orderby', ())),
+            groupby,
+            props.get('having'),
         )
         return len(values.fetchall())
 
     __len__ = count
 
+    def query(self, *columns, **props):
+        """Selects ``columns`` lazily. See ``Query``."""
+        return Query(self, columns, props)
+
+    def subselect(self, column):
+        """Selects ``column`` from rows matching this query as part of
+        another query. See ``Where.belongs``."""
+        return Subselect(column, self._tables | column._tables,
+                         self._where_tree)
+
     def update(self, **values):
-        self._db.__driver__._update(self._tables.copy().pop()._name,
-                                    self._where_tree, values)
+        table = self._tables.copy().pop()
+        if table._partition_by in values:
+            raise ValueError("Rows can't be moved between partitions")
+        values = table._todb_updates(values)
+        for name in table._targets(self._where_tree):
+            self._db.__driver__._update(name, self._where_tree, values,
+                                        alias=table._name)
 
     def delete(self):
-        self._db.__driver__._delete(self._tables.copy().pop()._name,
-                                    self._where_tree)
+        table = self._tables.copy().pop()
+        for name in table._targets(self._where_tree):
+            self._db.__driver__._delete(name, self._where_tree,
+                                        alias=table._name)
+
+
+class Subselect(object):
+    """Select statement used as a value inside a query
+
+    Created by ``Selectable.subselect``. Drivers format ``_subselect`` as
+    the arguments of their ``_select`` method."""
+    def __init__(self, column, tables, where_tree):
+        self._subselect = ([column], tables, where_tree, False, ())
+
+    def __repr__(self):
+        return 'Subselect(%r)' % self._subselect[0][0]
+
+
+class Query(object):
+    """Select statement which is built up step by step and only executed
+    when its rows are needed.
+
+    Created by ``Selectable.query``. Each of ``filter``, ``orderby``,
+    ``limit`` and ``columns`` returns a new query, leaving the original
+    unchanged. The SQL is compiled once per query and executed each time
+    the query is iterated, or by ``first``, ``exists`` and ``count``.
+
+    >>> mydb = DB()
+    >>> mydb.define_table('test_query', StrColumn('name'), IntColumn('value'))
+    >>> t = mydb.test_query
+    >>> t.insert_many(*(dict(name=c, value=i) for i, c in enumerate('abcde')))
+    >>> query = t.query(t.name).filter(t.value > 1)
+    >>> recent = query.orderby(reversed(t.value)).limit(2)
+    >>> [row.name for row in recent]
+    ['e', 'd']
+    >>> recent.sql  # doctest: +NORMALIZE_WHITESPACE
+    'SELECT "test_query"."name", "test_query"."rowid" FROM "test_query"
+     WHERE "test_query"."value">1 ORDER BY "test_query"."value" DESC
+     LIMIT 2;'
+    >>> query.filter(t.value < 4).count()
+    2
+    >>> query.first()
+    Row(name='c')
+    >>> query.filter(t.name == 'z').exists()
+    False
+    """
+    def __init__(self, source, columns=(), props=None):
+        self._source = source
+        self._columns = columns
+        self._props = props or {}
+        self._compiled = None
+
+    def _copy(self, source=None, columns=None, **props):
+        new = dict(self._props)
+        new.update(props)
+        return Query(self._source if source is None else source,
+                     self._columns if columns is None else columns, new)
+
+    def filter(self, *conditions):
+        """Query for rows which also match each of ``conditions``"""
+        source = self._source
+        for condition in conditions:
+            source = source._refine(condition)
+        return self._copy(source)
+
+    def orderby(self, *columns):
+        """Query with rows ordered by ``columns`` instead"""
+        return self._copy(orderby=columns)
+
+    def limit(self, count):
+        """Query for at most ``count`` rows"""
+        return self._copy(limit=count)
+
+    def columns(self, *columns):
+        """Query selecting ``columns`` instead"""
+        return self._copy(columns=columns)
+
+    def _compile(self):
+        if self._compiled is None:
+            driver = self._source._db.__driver__
+            all_columns, columns, primarykey, args = \
+                self._source._select_args(self._columns, self._props)
+            values = []
+            self._compiled = (
+                driver.select_sql(*driver._select_args(*args,
+                                                       parameters=values)),
+                values, all_columns, columns, primarykey, args)
+        return self._compiled
+
+    @property
+    def sql(self):
+        return self._compile()[0]
+
+    def __iter__(self):
+        sql, values, all_columns, columns, primarykey, args = self._compile()
+        driver = self._source._db.__driver__
+        with driver.time_limit(self._props.get('timeout')):
+            values = driver._select_compiled(sql, values, args)
+        return Selection(all_columns, columns, primarykey, values)
+
+    def first(self):
+        """The first row, or None if no rows match"""
+        return iter(self.limit(1)).one()
+
+    def exists(self):
+        if self._props.get('groupby') or self._props.get('limit') == 0:
+            return self.first() is not None
+        return self._source.exists()
+
+    def count(self):
+        props = dict(self._props)
+        limit = props.pop('limit', None)
+        count = self._source.count(**props)
+        return count if limit is None else min(count, limit)
+
+    def __repr__(self):
+        return 'Query(%r)' % self.sql
+
+
+class Appender(object):
+    """Buffers rows for a table and inserts them in bulk.
+
+    Created by ``Table.appender``. Rows are inserted once ``max_rows`` are
+    buffered, ``max_delay`` seconds after the oldest buffered row was
+    appended, when ``flush`` or ``close`` is called, when a ``with`` block
+    ends, and when the interpreter exits. ``stats`` counts flushes, the
+    rows they inserted, and the seconds spent flushing.
+
+    Rows which reach ``max_delay`` are inserted by a timer thread, on a
+    connection of its own. If that fails, the error is printed and the rows
+    stay buffered for the next flush. Drivers which can't open another
+    connection, like in-memory sqlite databases, insert them when the next
+    row is appended instead.
+
+    >>> mydb = DB()
+    >>> mydb.define_table('test_appender', StrColumn('event'))
+    >>> with mydb.test_appender.appender(max_rows=2) as log:
+    ...   for event in 'abc':
+    ...     log.append(event=event)
+    ...   print(len(mydb.test_appender))
+    2
+    >>> len(mydb.test_appender)
+    3
+    >>> log.stats['flushes'], log.stats['rows']
+    (2, 3)
+    """
+    def __init__(self, table, max_rows=1000, max_delay=None):
+        self.table = table
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.stats = {'flushes': 0, 'rows': 0, 'seconds': 0.0}
+        self._rows = []
+        self._oldest = None
+        self._timer = None
+        self._lock = threading.RLock()
+        # A weak reference, so that appenders which aren't closed can still
+        # be collected
+        self._atexit = functools.partial(_flush_appender, weakref.ref(self))
+        atexit.register(self._atexit)
+
+    def append(self, **values):
+        with self._lock:
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.append(values)
+            if len(self._rows) >= self.max_rows or (
+                    self.max_delay is not None and
+                    time.monotonic() - self._oldest >= self.max_delay):
+                self.flush()
+            elif self.max_delay is not None and self._timer is None:
+                self._timer = threading.Timer(
+                    self._oldest + self.max_delay - time.monotonic(),
+                    _flush_appender, (weakref.ref(self), True))
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Inserts the buffered rows. If inserting fails, the rows stay
+        buffered."""
+        with self._lock:
+            self._insert(self.table.insert_many)
+
+    def _expire(self):
+        """Inserts the buffered rows from the timer thread, on a clone of
+        the database's driver"""
+        with self._lock:
+            if self._timer is not threading.current_thread():
+                # Rows were flushed since, and a new timer started
+                return
+            self._timer = None
+            try:
+                driver = self.table._db.__driver__.clone()
+            except (ValueError, NotImplementedError):
+                return
+            try:
+                self._insert(functools.partial(self._insert_many, driver))
+            except Exception:
+                # Nobody is waiting for the timer to raise. The rows stay
+                # buffered for the next flush.
+                traceback.print_exc()
+            finally:
+                driver.connection.close()
+
+    def _insert_many(self, driver, *records):
+        with driver:
+            # Partitions are created on the clone too
+            for name, columns, rows in self.table._batches(records, driver):
+                driver._insert_many(name, columns, rows)
+
+    def _insert(self, insert_many):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        start = time.monotonic()
+        try:
+            insert_many(*rows)
+        except Exception:
+            self._rows = rows + self._rows
+            raise
+        self.stats['flushes'] += 1
+        self.stats['rows'] += len(rows)
+        self.stats['seconds'] += time.monotonic() - start
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self._atexit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, obj, exc, tb):
+        self.close()
+
+    def __len__(self):
+        # Waits for a flush in progress
+        with self._lock:
+            return len(self._rows)
+
+
+def _flush_appender(ref, expired=False):
+    appender = ref()
+    if appender is not None:
+        if expired:
+            appender._expire()
+        else:
+            appender.flush()
 
 
 class Where(Selectable):
@@ -519,6 +1249,11 @@ class Where(Selectable):
     def max(self):
         return Where(self, drivers.base.MAX, self)
 
+    def tally(self):
+        """Aggregate counting the values of this expression which aren't
+        NULL. (``count`` counts the rows matching a query.)"""
+        return Where(self, drivers.base.COUNT, self, native_type=int)
+
     def round(self, precision=None):
         return (Where(self, drivers.base.ROUND, self)
                 if precision is None else
@@ -532,6 +1267,42 @@ class Where(Selectable):
     def glob(self, pattern):
         return Where(self, drivers.base.GLOB, self, pattern)
 
+    def _fulltext(self):
+        table = getattr(self, 'table', None)
+        if table is None or self.name not in table._fulltext:
+            raise ValueError('%r is not a full-text indexed column' % self)
+
+    def match(self, query):
+        """Searches this column's full-text index for ``query``, using
+        the database's search syntax. Columns are indexed by
+        ``define_table(..., fulltext=[columns])``.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_match', StrColumn('title'),
+        ...                   StrColumn('body'), fulltext=['body'])
+        >>> posts = mydb.test_match
+        >>> posts.insert_many(
+        ...     dict(title='Fox', body='the quick brown fox'),
+        ...     dict(title='Dog', body='a lazy dog'),
+        ...     dict(title='Foxes', body='a fox chases a fox'))
+        >>> [row.title for row in posts.body.match('fox').select()]
+        ['Fox', 'Foxes']
+
+        ``relevance`` ranks the results, higher for better matches.
+        >>> [row.title for row in posts.body.match('fox').select(
+        ...     orderby=reversed(posts.body.relevance('fox')))]
+        ['Foxes', 'Fox']
+        """
+        self._fulltext()
+        return Where(self, drivers.base.MATCH, self, query, native_type=bool)
+
+    def relevance(self, query):
+        """How well this column's value matches ``query``; see ``match``.
+        ``None`` for rows which don't match in some databases."""
+        self._fulltext()
+        return Where(self, drivers.base.RELEVANCE, self, query,
+                     native_type=float)
+
     def strip(self):
         return Where(self, drivers.base.STRIP, self)
 
@@ -578,11 +1349,77 @@ class Where(Selectable):
     def between(self, min, max):
         return Where(self, drivers.base.BETWEEN, self, min, max)
 
+    def belongs(self, values):
+        """Tests whether this expression's value is one of ``values``, which
+        may be any iterable, or the result of ``Selectable.subselect``.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_belongs', IntColumn('key'))
+        >>> mydb.test_belongs.insert_many(*(dict(key=x) for x in range(5)))
+        >>> t = mydb.test_belongs
+        >>> t.key.belongs([1, 3, 3])
+        Where([BELONGS, 'test_belongs'.'key', (1, 3)])
+        >>> [row.key for row in t.key.belongs([1, 3, 3]).select()]
+        [1, 3]
+        >>> inner = (t.key > 2).subselect(t.key)
+        >>> [row.key for row in t.key.belongs(inner).select()]
+        [3, 4]
+        """
+        if not hasattr(values, '_subselect'):
+            # Duplicates would only lengthen the statement
+            values = drivers.base.valuelist(dict.fromkeys(values))
+        return Where(self, drivers.base.BELONGS, self, values)
+
 
 def ident(x):
     return x
 
 
+# Compressed values start with a marker and a codec byte, so values stored
+# before a column was compressed are still read as they are.
+_COMPRESSED = b'\x00\x1f'
+_codecs = {
+    'zlib': (b'z', zlib.compress, zlib.decompress),
+    'lzma': (b'x', lzma.compress, lzma.decompress),
+    None: (b'-', bytes, bytes),
+}
+_decompressors = {tag: decompress for tag, _, decompress in _codecs.values()}
+
+
+def _compressing(codec, native_type, todb, fromdb):
+    """Wraps ``todb`` and ``fromdb`` to store values compressed with
+    ``codec``"""
+    if codec not in _codecs or codec is None:
+        raise ValueError('Unknown compression codec %r' % (codec,))
+    text = native_type is str
+    # Partials of module functions, unlike closures, can be pickled
+    return (functools.partial(_compress, codec, text, todb),
+            functools.partial(_decompress, text, fromdb))
+
+
+def _compress(codec, text, todb, value):
+    if value is None:
+        return value
+    if todb:
+        value = todb(value)
+    if text:
+        value = value.encode('utf-8')
+    tag, compress, _ = _codecs[codec]
+    packed = compress(value)
+    # Values which don't shrink are stored as they are
+    if len(packed) < len(value):
+        return _COMPRESSED + tag + packed
+    return _COMPRESSED + _codecs[None][0] + value
+
+
+def _decompress(text, fromdb, value):
+    if isinstance(value, bytes) and value[:2] == _COMPRESSED:
+        value = _decompressors[value[2:3]](value[3:])
+        if text:
+            value = value.decode('utf-8')
+    return fromdb(value) if fromdb else value
+
+
 class Column(Where):
     """Object representing a single column in a database table.
 
@@ -626,10 +1463,25 @@ class Column(Where):
     :``autoincrement=False``: Boolean value. If true, an
       incrementally-increasing integer value is inserted by default by
       the database.
+    :``index=False``: Boolean value. If true, the database maintains an
+      index of this column's values, which speeds up queries comparing
+      against it at the cost of slower writes.
+    :``deferred=False``: Boolean value. If true, selecting a table's
+      columns leaves this one out. Reading it from a row selects it for
+      the rows of the selection read with it, a batch at a time, so large
+      values are only loaded when needed. See also ``Table.open_blob``.
+    :``compressed=False``: If true, values are compressed with zlib
+      before being stored. May also name the codec, ``'zlib'`` or
+      ``'lzma'``. The database stores compressed columns as ``bytes``,
+      so their values can't be compared in queries, except against
+      ``None``. Values stored before a column was compressed are read
+      unaltered. Combine with ``deferred=True`` to only read and
+      decompress values which are used.
     """
     def __init__(self, name, native_type, todb=None, fromdb=None,
                  required=False, default=None, unique=False, primarykey=False,
-                 references=None, length=None, autoincrement=False):
+                 references=None, length=None, autoincrement=False,
+                 index=False, deferred=False, compressed=False):
         Selectable.__init__(self)
         self.name = name
         self.table = None
@@ -643,6 +1495,17 @@ class Column(Where):
         self.references = references
         self.length = length
         self.autoincrement = bool(autoincrement)
+        self.index = bool(index)
+        self.deferred = bool(deferred)
+        self.compressed = bool(compressed)
+        if compressed:
+            self.todb, self.fromdb = _compressing(
+                'zlib' if compressed is True else compressed,
+                native_type, todb, fromdb)
+
+    @property
+    def _storage_type(self):
+        return bytes if self.compressed else self.native_type
 
     @property
     def _tables(self):
@@ -755,7 +1618,8 @@ class Table(Selectable):
     >>> t.primarykey[0].name
     'rowid'
     """
-    def __init__(self, db, name, columns, primarykey=None):
+    def __init__(self, db, name, columns, primarykey=None, fulltext=(),
+                 versioned=False, shard_key=None):
         Selectable.__init__(self)
         self._db = db
         self._name = name
@@ -781,6 +1645,15 @@ class Table(Selectable):
                     self.primarykey.append(col)
         for col in self._columns:
             col.table = self
+        self._fulltext = [getattr(col, 'name', col) for col in fulltext]
+        self._versioned = bool(versioned)
+        for col in self._fulltext:
+            if col not in self._columns:
+                raise KeyError('No such column in table: %s' % col)
+        self._shard_key = getattr(shard_key, 'name', shard_key)
+        if self._shard_key is not None and self._shard_key not in [
+                c.name for c in self.primarykey]:
+            raise ValueError('The shard key must be part of the primary key')
 
     def __getattr__(self, key):
         if key in self.__dict__:
@@ -788,6 +1661,55 @@ class Table(Selectable):
         else:
             return self._columns[key]
 
+    # Name of the column whose value decides which table stores a row. See
+    # PartitionedTable.
+    _partition_by = None
+
+    def _partition(self, value, driver=None):
+        """Name of the table which stores rows whose partition column has
+        ``value``, created through ``driver`` if it's needed"""
+        return self._name
+
+    def _route(self, rows, keys):
+        """Groups ``rows`` by the table storing them, given the value of the
+        partition column of each in ``keys``"""
+        return [(self._name, rows)]
+
+    def _targets(self, conditions):
+        """Names of the tables which might hold rows matching
+        ``conditions``"""
+        return [self._name]
+
+    def _physical_names(self):
+        return [self._name]
+
+    @property
+    def _selected(self):
+        """Columns selected by default, i.e. not deferred"""
+        return [c for c in self.ALL if not c.deferred]
+
+    def open_blob(self, column, key):
+        """Opens the value of ``column`` in the row with primary key
+        ``key`` as a binary file, which reads the value from the database in
+        pieces. Suitable for ``Response.stream``. Compressed columns
+        can't be read in pieces.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_blob', StrColumn('name'),
+        ...                   DataColumn('data', deferred=True))
+        >>> t = mydb.test_blob
+        >>> t.insert(name='a', data=b'0123456789')
+        >>> blob = t.open_blob(t.data, 1)
+        >>> blob.read(4), blob.read(4), blob.read(4), blob.read(4)
+        (b'0123', b'4567', b'89', b'')
+        """
+        if isinstance(column, str):
+            column = self._columns[column]
+        if column.compressed:
+            raise ValueError("Compressed columns can't be read in pieces")
+        return self._db.__driver__._open_blob(
+            self._name, column.name, self._by_pk(key)._where_tree)
+
     def __hash__(self):
         return hash(self._name)
 
@@ -805,7 +1727,7 @@ class Table(Selectable):
         raise TypeError('Table %r has no primarykey' % (self._name))
 
     def __getitem__(self, key):
-        result = self._by_pk(key).select(self.ALL).one()
+        result = self._by_pk(key).select(self._selected).one()
         if result is None:
             raise KeyError('No Row in database matching primary key %s' % (
                 repr(sequence(key))[1:-1]))
@@ -814,7 +1736,14 @@ class Table(Selectable):
     def __delitem__(self, key):
         self._by_pk(key).delete()
 
-    def insert(self, **values):
+    def _todb_updates(self, values):
+        """``values`` of an update converted for the database. Unknown
+        columns are left for the driver to reject."""
+        todb = {k: getattr(self._columns.get(k), 'todb', None)
+                for k in values}
+        return {k: todb[k](v) if todb[k] else v for k, v in values.items()}
+
+    def _todb(self, values):
         db_values = []
         for k, v in values.items():
             try:
@@ -827,11 +1756,249 @@ class Table(Selectable):
                 raise
             except KeyError:
                 raise KeyError('No such column in table: %s' % k)
-        self._db.__driver__._insert(self._name, list(values.keys()), db_values)
+        return db_values
+
+    def _batches(self, records, driver=None):
+        """Groups consecutive records with the same columns, stored in the
+        same table, converting them for the database"""
+        for (columns, name), group in itertools.groupby(
+                records, lambda record: (tuple(record.keys()),
+                                         self._partition(record.get(
+                                             self._partition_by), driver))):
+            yield name, list(columns), [self._todb(record)
+                                        for record in group]
+
+    def insert(self, **values):
+        self._db.__driver__._insert(
+            self._partition(values.get(self._partition_by)),
+            list(values.keys()), self._todb(values))
 
     def insert_many(self, *records):
-        for record in records:
-            self.insert(**record)
+        with self._db:
+            for name, columns, rows in self._batches(records):
+                self._db.__driver__._insert_many(name, columns, rows)
+
+    def import_csv(self, source, mapping=None, chunk=10000, **fmtparams):
+        """Inserts the rows of a CSV file, given as a path or an open file,
+        and returns the number of rows inserted.
+
+        The first row names the fields. ``mapping`` maps field names to
+        column names; other fields are ignored. Without ``mapping``, every
+        field must be named after a column. Empty fields are NULL, and other
+        values are parsed like values read from the database, so files
+        written by ``Selection.to_csv`` can be imported again. Rows are read
+        and inserted ``chunk`` at a time, each chunk in its own transaction.
+        Drivers may speed up loading, e.g. sqlite defers updating indexes.
+        Remaining keyword arguments are passed to ``csv.reader``.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_import', StrColumn('name'),
+        ...                   BoolColumn('flag'), IntColumn('value'))
+        >>> t = mydb.test_import
+        >>> t.import_csv(io.StringIO('n,value,flag\\na,1,True\\nb,,False\\n'),
+        ...              mapping={'n': 'name', 'value': 'value',
+        ...                       'flag': 'flag'}, chunk=1)
+        2
+        >>> list(t.select())
+        [Row(name='a', flag=True, value=1), Row(name='b', flag=False, value=None)]
+        """
+        close = isinstance(source, str)
+        fileobj = open(source, newline='') if close else source
+        try:
+            reader = csv.reader(fileobj, **fmtparams)
+            header = next(reader, None)
+            if header is None:
+                return 0
+            if mapping is None:
+                mapping = {name: name for name in header}
+            fields = [i for i, name in enumerate(header) if name in mapping]
+            columns = [mapping[header[i]] for i in fields]
+            converters = []
+            for name in columns:
+                if name not in self._columns:
+                    raise KeyError('No such column in table: %s' % name)
+                column = self._columns[name]
+                converters.append((_text_converter(column), column.todb))
+            partition = (columns.index(self._partition_by)
+                         if self._partition_by in columns else None)
+            driver = self._db.__driver__
+            count = 0
+            with driver._bulk_load(self._name):
+                while True:
+                    rows = list(itertools.islice(reader, chunk))
+                    if not rows:
+                        break
+                    values = []
+                    keys = itertools.repeat(None)
+                    for i, (convert, todb) in zip(fields, converters):
+                        column = [convert(row[i]) if row[i] else None
+                                  for row in rows]
+                        if len(values) == partition:
+                            keys = column
+                        if todb:
+                            column = [v if v is None else todb(v)
+                                      for v in column]
+                        values.append(column)
+                    with self._db:
+                        for name, batch in self._route(
+                                list(zip(*values)), keys):
+                            driver._insert_many(name, columns, batch)
+                    count += len(rows)
+            return count
+        finally:
+            if close:
+                fileobj.close()
+
+    def appender(self, max_rows=1000, max_delay=None):
+        """Buffers rows for bulk inserts. See ``Appender``."""
+        return Appender(self, max_rows, max_delay)
+
+    def insert_returning(self, **values):
+        """Inserts a row and returns it as stored in the database, including
+        defaults and autoincrement values.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_returning', StrColumn('key'),
+        ...                   IntColumn('value', default=7))
+        >>> mydb.test_returning.insert_returning(key='a')
+        Row(key='a', value=7)
+        >>> _.rowid
+        1
+        """
+        driver = self._db.__driver__
+        columns = self._selected + self.primarykey
+        selection = Selection(columns, self._selected, self.primarykey, None)
+        db_values = self._todb(values)
+        name = self._partition(values.get(self._partition_by))
+        with self._db:
+            if 'returning' in driver.features:
+                return selection._make_row(driver._insert_returning(
+                    name, list(values.keys()), db_values,
+                    [c.name for c in columns]).fetchone())
+            rowid = driver._insert(name, list(values.keys()), db_values)
+            key = [db_values[list(values).index(c.name)]
+                   if c.name in values else rowid for c in self.primarykey]
+            return self._by_pk(key).select(self._selected).one()
+
+    def _upsert_keys(self, columns):
+        if not self.primarykey:
+            raise TypeError('Table %r has no primarykey' % (self._name))
+        keys = [c.name for c in self.primarykey]
+        for key in keys:
+            if key not in columns:
+                raise KeyError('Upsert requires a value for primary key'
+                               ' column: %s' % key)
+        return keys
+
+    def upsert(self, **values):
+        """Inserts a row, or updates the row which has the same primary key.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_upsert', StrColumn('key'),
+        ...                   IntColumn('value'), primarykey='key')
+        >>> mydb.test_upsert.upsert(key='a', value=1)
+        >>> mydb.test_upsert.upsert(key='a', value=2)
+        >>> list(mydb.test_upsert.select())
+        [Row(key='a', value=2)]
+        >>> mydb.test_upsert.upsert(value=3)
+        Traceback (most recent call last):
+         ...
+        KeyError: 'Upsert requires a value for primary key column: key'
+        """
+        self._db.__driver__._upsert(
+            self._partition(values.get(self._partition_by)),
+            list(values.keys()), self._upsert_keys(values),
+            self._todb(values))
+
+    def upsert_many(self, *records):
+        """Upserts each of ``records``, executing consecutive records with
+        the same columns as a single batch."""
+        with self._db:
+            for name, columns, rows in self._batches(records):
+                self._db.__driver__._upsert_many(
+                    name, columns, self._upsert_keys(columns), rows)
+
+    def _by_keys(self, keys):
+        """Query for rows with any of the primary keys in ``keys``"""
+        if len(self.primarykey) == 1:
+            return self.primarykey[0].belongs(
+                sequence(key)[0] for key in keys)
+        return reduce(lambda x, y: x | y, map(self._by_pk, keys))
+
+    def _key_chunks(self, keys, chunk):
+        """Lists of at most ``chunk`` primary keys, taken from a sequence
+        of keys or the rows matching a query"""
+        if not self.primarykey:
+            raise TypeError('Table %r has no primarykey' % (self._name))
+        if hasattr(keys, '_where_tree'):
+            if keys._tables != {self}:
+                raise TypeError('Query must only select rows of %r' %
+                                self._name)
+            for page in keys.pages(chunk, *self.primarykey,
+                                   orderby=self.primarykey):
+                yield [tuple(row) for row in page]
+            return
+        keys = iter(keys)
+        while True:
+            page = list(itertools.islice(keys, chunk))
+            if not page:
+                return
+            yield page
+
+    def update_many(self, keys, values, chunk=1000):
+        """Sets ``values`` on the rows with primary keys in ``keys``, or
+        on the rows matching the query ``keys``. Rows are updated ``chunk``
+        at a time, each chunk in its own transaction, so locks are held
+        briefly. Rows aren't selected again. Returns the number of rows
+        updated.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_update_many', IntColumn('value'))
+        >>> t = mydb.test_update_many
+        >>> t.insert_many(*(dict(value=x) for x in range(10)))
+        >>> t.update_many([1, 2, 3], dict(value=-1), chunk=2)
+        3
+        >>> t.update_many(t.value > 6, dict(value=0), chunk=2)
+        3
+        >>> [row.value for row in t.select()]
+        [-1, -1, -1, 3, 4, 5, 6, 0, 0, 0]
+        """
+        if self._partition_by in values:
+            raise ValueError("Rows can't be moved between partitions")
+        values = self._todb_updates(values)
+        count = 0
+        for page in self._key_chunks(keys, chunk):
+            where = self._by_keys(page)._where_tree
+            with self._db:
+                for name in self._targets(where):
+                    count += self._db.__driver__._update(
+                        name, where, values, alias=self._name).rowcount
+        return count
+
+    def delete_many(self, keys, chunk=1000):
+        """Deletes the rows with primary keys in ``keys``, or the rows
+        matching the query ``keys``, ``chunk`` at a time. See
+        ``update_many``.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_delete_many', IntColumn('value'))
+        >>> t = mydb.test_delete_many
+        >>> t.insert_many(*(dict(value=x) for x in range(10)))
+        >>> t.delete_many(t.value % 3 == 0, chunk=2)
+        4
+        >>> t.delete_many([2, 3, 11])
+        2
+        >>> [row.value for row in t.select()]
+        [4, 5, 7, 8]
+        """
+        count = 0
+        for page in self._key_chunks(keys, chunk):
+            where = self._by_keys(page)._where_tree
+            with self._db:
+                for name in self._targets(where):
+                    count += self._db.__driver__._delete(
+                        name, where, alias=self._name).rowcount
+        return count
 
     @property
     def _tables(self):
@@ -842,6 +2009,8 @@ class Table(Selectable):
         return []
 
     def drop(self):
+        if self._fulltext:
+            self._db.__driver__._drop_fulltext(self._name)
         self._db.__driver__.drop_table(self._name)
         del self._db[self._name]
 
@@ -866,6 +2035,249 @@ class Table(Selectable):
 __all__.append('Table')
 
 
+class Aggregate(Table):
+    """Table holding the sums of some columns of ``source``, and the
+    number of rows summed, for each distinct value of the ``groupby``
+    columns. Created by ``DB.define_aggregate``, and kept up to date by
+    the database as rows of ``source`` are inserted, updated and deleted.
+    """
+    def __init__(self, db, name, source, groupby, sums):
+        self._source = source
+        self._groupby = [c.name for c in groupby]
+        self._sums = [c.name for c in sums]
+        columns = [Column(c.name, c.native_type, todb=c.todb, fromdb=c.fromdb)
+                   for c in groupby]
+        columns.extend(Column(c.name, c.native_type, required=True)
+                       for c in sums)
+        columns.append(IntColumn('rows', required=True))
+        Table.__init__(self, db, name, columns,
+                       primarykey=self._groupby or None)
+
+    def _create_triggers(self):
+        self._db.__driver__._create_aggregate(
+            self._name, self._source._name, self._groupby, self._sums)
+
+    def rebuild(self):
+        """Recomputes every row from ``source``"""
+        self._db.__driver__._rebuild_aggregate(
+            self._name, self._source._name, self._groupby, self._sums)
+
+    def drop(self):
+        self._db.__driver__._drop_aggregate(self._name)
+        Table.drop(self)
+
+__all__.append('Aggregate')
+
+
+class PartitionedTable(Table):
+    """Table whose rows are stored in a separate table for each period of
+    time (``'day'``, ``'month'`` or ``'year'``), decided by the value of
+    the ``DateTimeColumn`` ``partition_by``. Created by
+    ``define_table(..., partition_by=column, interval='month')``.
+
+    Partitions are named after the table and the start of their period,
+    e.g. ``events__202610``, and created as rows are inserted into them.
+    Rows whose partition column is NULL are kept in the table itself.
+    Queries only read the partitions which can match bounds on the
+    partition column (comparisons, ``==`` and ``between``, combined with
+    ``&``), so recent rows are found without reading old ones. Old
+    periods are removed with ``drop_partitions``, a ``DROP TABLE`` per
+    partition.
+
+    The list of partitions is read from the database once, and kept up to
+    date as this table creates and drops them. Partitions created by other
+    connections are found after ``partitions`` is called again.
+
+    Rows are found by primary key in every partition, so the primary key
+    must be unique across partitions, and can't be an autoincrement
+    column. Updates can't change the partition column.
+
+    >>> mydb = DB()
+    >>> mydb.define_table('test_events', StrColumn('id'),
+    ...                   DateTimeColumn('created'), primarykey='id',
+    ...                   partition_by='created', interval='month')
+    >>> events = mydb.test_events
+    >>> events.insert_many(
+    ...     dict(id='a', created=datetime.datetime(2026, 9, 30)),
+    ...     dict(id='b', created=datetime.datetime(2026, 10, 1)),
+    ...     dict(id='c', created=datetime.datetime(2026, 10, 18)))
+    >>> events.partitions()
+    [datetime.datetime(2026, 9, 1, 0, 0), datetime.datetime(2026, 10, 1, 0, 0)]
+    >>> recent = events.created >= datetime.datetime(2026, 10, 1)
+    >>> [row.id for row in recent.select()]
+    ['b', 'c']
+    >>> mydb.lastsql.partition(' FROM ')[2].partition(' WHERE ')[0]
+    '"test_events__202610" AS "test_events"'
+    >>> events.drop_partitions(before=datetime.datetime(2026, 10, 1))
+    1
+    >>> [row.id for row in events.select()]
+    ['b', 'c']
+    """
+    _formats = {'day': '%Y%m%d', 'month': '%Y%m', 'year': '%Y'}
+    _flipped = {'EQUAL': 'EQUAL', 'LESSTHAN': 'GREATERTHAN',
+                'LESSEQUAL': 'GREATEREQUAL', 'GREATERTHAN': 'LESSTHAN',
+                'GREATEREQUAL': 'LESSEQUAL'}
+
+    def __init__(self, db, name, columns, partition_by, interval='month',
+                 **kwargs):
+        if interval not in self._formats:
+            raise ValueError('Unknown partition interval %r' % interval)
+        if kwargs.get('fulltext') or kwargs.get('versioned'):
+            raise ValueError("Partitioned tables can't be full-text indexed"
+                             " or versioned")
+        Table.__init__(self, db, name, columns, **kwargs)
+        self._partition_by = getattr(partition_by, 'name', partition_by)
+        if self._partition_by not in self._columns:
+            raise KeyError('No such column in table: %s' % self._partition_by)
+        if any(c.autoincrement for c in self.primarykey):
+            raise ValueError('Partitioned tables need a primary key which is'
+                             ' unique across partitions')
+        self._interval = interval
+        self._created = set()
+        self._starts = None
+
+    def _start(self, value):
+        """Start of the period containing ``value``"""
+        if isinstance(value, str):
+            value = drivers.base.timestamp.parse(value)
+        if self._interval == 'year':
+            return datetime.datetime(value.year, 1, 1)
+        elif self._interval == 'month':
+            return datetime.datetime(value.year, value.month, 1)
+        return datetime.datetime(value.year, value.month, value.day)
+
+    def _next(self, start):
+        """Start of the period after the one starting at ``start``"""
+        if self._interval == 'year':
+            return start.replace(year=start.year + 1)
+        elif self._interval == 'month':
+            return start.replace(year=start.year + start.month // 12,
+                                 month=start.month % 12 + 1)
+        return start + datetime.timedelta(days=1)
+
+    def _partition_name(self, start):
+        return '%s__%s' % (self._name,
+                           start.strftime(self._formats[self._interval]))
+
+    def _partition(self, value, driver=None):
+        if value is None:
+            return self._name
+        name = self._partition_name(self._start(value))
+        if name not in self._created:
+            self._db._create_table(self, name, driver)
+            self._created.add(name)
+            self._starts = None
+        return name
+
+    def _route(self, rows, keys):
+        groups = {}
+        for row, key in zip(rows, keys):
+            groups.setdefault(self._partition(key), []).append(row)
+        return groups.items()
+
+    def partitions(self):
+        """Start of the period of each partition in the database, in
+        order"""
+        prefix = '%s__' % self._name
+        starts = []
+        for name in self._db.__driver__.list_tables():
+            if name.startswith(prefix):
+                try:
+                    starts.append(datetime.datetime.strptime(
+                        name[len(prefix):], self._formats[self._interval]))
+                except ValueError:
+                    pass
+        self._starts = sorted(starts)
+        return list(self._starts)
+
+    def _known(self):
+        """Start of the period of each partition, read from the database
+        once"""
+        if self._starts is None:
+            self.partitions()
+        return self._starts
+
+    def _physical_names(self):
+        return [self._name] + list(map(self._partition_name, self._known()))
+
+    def _bound(self, value):
+        if isinstance(value, str):
+            try:
+                value = drivers.base.timestamp.parse(value)
+            except ValueError:
+                return None
+        if isinstance(value, datetime.datetime):
+            return value
+        elif isinstance(value, datetime.date):
+            return datetime.datetime.combine(value, datetime.time())
+
+    def _bounds(self, conditions):
+        """Lowest and highest values of the partition column which can
+        match ``conditions``, or ``None`` if unbounded"""
+        column = self._columns[self._partition_by]
+        low = high = None
+        stack = [conditions]
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, list) or not node:
+                continue
+            name, args = repr(node[0]), node[1:]
+            if name == 'AND':
+                stack.extend(args)
+                continue
+            if name == 'BETWEEN' and args[0] is column:
+                name, bounds = None, map(self._bound, args[1:])
+            elif name in self._flipped and (args[0] is column or
+                                            args[1] is column):
+                if args[1] is column:
+                    name, args = self._flipped[name], args[::-1]
+                bound = self._bound(args[1])
+                bounds = (bound if name in ('EQUAL', 'GREATERTHAN',
+                                            'GREATEREQUAL') else None,
+                          bound if name in ('EQUAL', 'LESSTHAN',
+                                            'LESSEQUAL') else None)
+            else:
+                continue
+            lower, upper = bounds
+            if lower is not None and (low is None or lower > low):
+                low = lower
+            if upper is not None and (high is None or upper < high):
+                high = upper
+        return low, high
+
+    def _targets(self, conditions):
+        low, high = self._bounds(conditions)
+        # NULLs in the table itself can't match any bound
+        names = [] if low or high else [self._name]
+        names.extend(
+            self._partition_name(start) for start in self._known()
+            if (high is None or start <= high) and
+            (low is None or self._next(start) > low))
+        return names or [self._name]
+
+    def drop_partitions(self, before):
+        """Drops every partition whose period ended by ``before``, and
+        returns how many were dropped"""
+        count = 0
+        for start in self.partitions():
+            if self._next(start) <= before:
+                name = self._partition_name(start)
+                self._db.__driver__._drop_table(name)
+                self._created.discard(name)
+                count += 1
+        self._starts = None
+        return count
+
+    def drop(self):
+        for start in self.partitions():
+            self._db.__driver__._drop_table(self._partition_name(start))
+        self._created.clear()
+        self._starts = None
+        Table.drop(self)
+
+__all__.append('PartitionedTable')
+
+
 class UnknownDriver(Exception):
     pass
 
@@ -882,6 +2294,7 @@ class DB(collection):
     """
     __driver__ = drivers.sqlite.sqlite()
     execute = __driver__.execute
+    retry = __driver__.retry
     __enter__ = __driver__.__enter__
     __exit__ = __driver__.__exit__
 
@@ -910,11 +2323,135 @@ class DB(collection):
             kwargs['primarykey'] = primarykey
         elif kwargs.get('primarykey'):
             kwargs['primarykey'] = sequence(kwargs['primarykey'])
-        value = Table(self, name, flatten(columns), **kwargs)
-        self.__driver__._create_table_if_nexists(
-            name, value._columns, [pk.name for pk in value.primarykey])
+        if kwargs.get('partition_by') is None:
+            kwargs.pop('partition_by', None)
+            value = Table(self, name, flatten(columns), **kwargs)
+        else:
+            value = PartitionedTable(self, name, flatten(columns), **kwargs)
+        self._create_table(value)
         collection.add(self, value)
 
+    def define_aggregate(self, name, source, groupby=(), sums=()):
+        """Defines an ``Aggregate`` table ``name``, which holds the sums of
+        the columns ``sums`` of table ``source`` for each distinct value of
+        the ``groupby`` columns, and the number of rows in each group as
+        ``rows``. Reading the aggregate is a lookup rather than a scan of
+        ``source``. Triggers keep it up to date with every change to
+        ``source``, in the same transaction. A new aggregate is filled from
+        the rows already in ``source``; ``rebuild`` does the same again.
+        The groups are the aggregate's primary key, so on databases whose
+        primary keys can't hold NULL, like MySQL, ``groupby`` columns must
+        be required.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_orders', StrColumn('day'),
+        ...                   IntColumn('amount'))
+        >>> orders = mydb.test_orders
+        >>> orders.insert_many(dict(day='mon', amount=3),
+        ...                    dict(day='tue', amount=4))
+        >>> mydb.define_aggregate('test_daily', orders, groupby=orders.day,
+        ...                       sums=orders.amount)
+        >>> orders.insert(day='mon', amount=5)
+        >>> (orders.day == 'tue').delete()
+        >>> list(mydb.test_daily.select())
+        [Row(day='mon', amount=8, rows=2)]
+        """
+        if hasattr(self, name):
+            raise AttributeError("%s already defined" % name)
+        if isinstance(source, PartitionedTable):
+            raise TypeError("Partitioned tables can't be aggregated")
+        groupby, sums = sequence(groupby), sequence(sums)
+        # Groups are the primary key of the aggregate, so NULL can only be
+        # a group if primary keys can hold it
+        nullable = [c.name for c in groupby if not c.required]
+        if nullable and not self.__driver__.null_primarykeys:
+            raise ValueError(
+                "%s can't group by columns which may be NULL: %s" % (
+                    type(self.__driver__).__name__, ', '.join(nullable)))
+        table = Aggregate(self, name, source, groupby, sums)
+        new = name not in self.__driver__.list_tables()
+        self._create_table(table)
+        table._create_triggers()
+        if new:
+            table.rebuild()
+        collection.add(self, table)
+
+    def _create_table(self, table, name=None, driver=None):
+        """Creates ``table``, or a partition of it named ``name``, by
+        default through the database's driver"""
+        if driver is None:
+            driver = self.__driver__
+        name = name or table._name
+        if table._shard_key is not None:
+            driver._shard_by(name, table._shard_key)
+        indexed = [c for c in table._columns if c.index and not c.unique]
+        # Existing tables might not have the indexed columns yet. Their
+        # indexes are left for migrate to add.
+        if indexed and name in driver.list_tables():
+            indexed = []
+        driver._create_table_if_nexists(
+            name, table._columns, [pk.name for pk in table.primarykey])
+        for column in indexed:
+            self._create_index(name, column, driver)
+        if name != table._name:
+            return
+        if table._fulltext:
+            driver._create_fulltext(table._name, table._fulltext)
+        if table._versioned:
+            self._track_versions(table)
+
+    def _versions_table(self):
+        return Table(self, 'webdb_versions', [
+            StrColumn('name'), IntColumn('version', required=True)],
+            primarykey=['name'])
+
+    def _track_versions(self, table):
+        versions = self._versions_table()
+        self._create_table(versions)
+        if not versions._by_pk(table._name).exists():
+            try:
+                versions.insert(name=table._name, version=0)
+            except ValueError:
+                pass  # Inserted by another connection meanwhile
+        self.__driver__._create_versioning(table._name, versions._name)
+
+    def versions(self, *tables):
+        """Reads the version of each of ``tables`` (by default, every table
+        defined with ``versioned=True``), as a dict of table names to
+        integers. A table's version goes up by one with each statement
+        which inserts, updates or deletes its rows, in the same
+        transaction, so a cache of reads can tell if they're stale, even in
+        another process, by comparing versions. Only writes made by
+        databases which define the table with ``versioned=True`` are
+        counted, not SQL run with ``execute``. Versions are kept in the
+        ``webdb_versions`` table, one row per table, and aren't reset when
+        a table is dropped.
+
+        >>> mydb = DB()
+        >>> mydb.define_table('test_versions', StrColumn('key'),
+        ...                   versioned=True)
+        >>> mydb.versions()
+        {'test_versions': 0}
+        >>> mydb.test_versions.insert_many(dict(key='a'), dict(key='b'))
+        >>> mydb.test_versions.insert(key='c')
+        >>> mydb.versions()
+        {'test_versions': 2}
+        """
+        names = ([getattr(table, '_name', table) for table in tables] or
+                 [table._name for table in self if table._versioned])
+        if not names:
+            return {}
+        versions = self._versions_table()
+        return {row.name: row.version for row in
+                versions.name.belongs(names).select()}
+
+    def _create_index(self, name, column, driver=None):
+        if driver is None:
+            driver = self.__driver__
+        driver._create_index(
+            name, '%s_%s_index' % (name, column.name),
+            [column.name], column.unique)
+
     def __getattr__(self, key):
         try:
             return self.__dict__[key] if key[0] == '_' else self[key]
@@ -940,10 +2477,36 @@ class DB(collection):
         return type(cls.__name__, (cls,), {
             '__driver__': driver,
             'execute': driver.execute,
+            'retry': driver.retry,
             '__enter__': driver.__enter__,
             '__exit__': driver.__exit__,
         })()
 
+    def snapshot(self, path=None):
+        """Copies the database, in memory or to the file at ``path``.
+        Table definitions aren't copied; restore the snapshot into a
+        database with the same definitions, or use ``conform``.
+
+        Snapshots make test fixtures cheap to reset:
+
+        >>> mydb = DB.connect('sqlite')
+        >>> mydb.define_table('test_snapshot', IntColumn('value'))
+        >>> mydb.test_snapshot.insert(value=1)
+        >>> fixture = mydb.snapshot()
+        >>> mydb.test_snapshot.insert(value=2)
+        >>> mydb.restore(fixture)
+        >>> [row.value for row in mydb.test_snapshot.select()]
+        [1]
+
+        The path of a file written by ``snapshot`` may be restored into an
+        in-memory database.
+        """
+        return self.__driver__.snapshot(path)
+
+    def restore(self, snapshot):
+        """Replaces the database with a copy of ``snapshot``"""
+        self.__driver__.restore(snapshot)
+
     def conform(self):
         """DB.conform()
 
@@ -957,19 +2520,151 @@ class DB(collection):
             t = Table(self, table, columns)
             collection.add(self, t)
 
-    def migrate(self):
-        """DB.migrate()
-
-        Alters database to match defined tables"""
-        names = set(self.keys())
-        db_tables = set(self.__driver__.list_tables())
-        for name in names - db_tables:
-            # Create
-            self.__driver__._create_table_if_nexists(name, self[name])
-        for name in names.intersection(db_tables):
-            # Alter if not the same
-            raise NotImplementedError
-            self.__driver__.alter_table(name, self[name])
+    def _physical_tables(self):
+        """Pairs of the name of each table in the database which stores
+        rows of a defined table, and the defined table"""
+        for table in self:
+            for name in table._physical_names():
+                yield name, table
+
+    def plan_migration(self, renames=None):
+        """DB.plan_migration(renames=None) -> list of operations
+
+        Compares defined tables against the tables in the database and lists
+        the steps ``migrate`` takes to make them match. Each step is a tuple
+        of an operation name, the name of the table it applies to, and any
+        further arguments:
+
+        :``('create_table', table)``: The table is missing.
+        :``('rename_column', table, column, old)``: The column exists under
+          the name ``old``.
+        :``('add_column', table, column)``: The column is missing.
+        :``('alter_column', table, column)``: The column's type or
+          nullability changed.
+        :``('rebuild_table', table)``: Some columns changed, but the driver
+          can't alter columns, so rows are copied into a table with the new
+          definition. Columns which aren't defined are dropped.
+        :``('add_index', table, column)``: The column should be indexed (or
+          made unique) but isn't.
+
+        Each partition of a ``PartitionedTable`` is compared and migrated
+        like a table of its own.
+
+        A renamed column can't be told apart from a dropped column and a new
+        one, so renames must be given in ``renames``, which maps
+        ``'table.column'`` to the name of the column in the database. Columns
+        in the database which aren't defined are otherwise ignored.
+
+        >>> mydb = DB.connect('sqlite')
+        >>> mydb.define_table('test', IntColumn('key'), StrColumn('name'))
+        >>> del mydb.test
+        >>> mydb.define_table('test', IntColumn('key'), StrColumn('title'),
+        ...                   StrColumn('value', index=True))
+        >>> renames = {'test.title': 'name'}
+        >>> mydb.plan_migration(renames)  # doctest: +NORMALIZE_WHITESPACE
+        [('rename_column', 'test', 'title', 'name'),
+         ('add_column', 'test', 'value'),
+         ('add_index', 'test', 'value')]
+        >>> mydb.migrate(renames)
+        >>> mydb.plan_migration()
+        []
+
+        sqlite can't alter columns, so changing a column's type rebuilds the
+        table.
+        >>> del mydb.test
+        >>> mydb.define_table('test', StrColumn('key'), StrColumn('title'))
+        >>> mydb.plan_migration()
+        [('rebuild_table', 'test')]
+        """
+        renames = renames or {}
+        driver = self.__driver__
+        db_tables = set(driver.list_tables())
+        plan = []
+        for name, table in self._physical_tables():
+            if name not in db_tables:
+                plan.append(('create_table', name))
+                continue
+            existing = {n: (v_type, notnull) for n, v_type, notnull, _ in
+                        driver._list_columns(name)}
+            indexes = {tuple(columns) for _, _, columns in
+                       driver._list_indexes(name)}
+            added, changed = [], []
+            for column in table._columns:
+                current = existing.get(column.name)
+                if current is None:
+                    old = renames.get('%s.%s' % (table._name, column.name))
+                    if old not in existing:
+                        added.append(column)
+                        continue
+                    plan.append(('rename_column', name, column.name, old))
+                    current = existing[old]
+                v_type, notnull = current
+                if ((v_type is not None and
+                     v_type is not column._storage_type)
+                        or (not column.primarykey and
+                            notnull != column.required)):
+                    changed.append(column)
+            if changed and 'alter_column' not in driver.features:
+                # The new definition includes added columns and unique
+                # constraints, but not indexes
+                plan.append(('rebuild_table', name))
+                added, indexes = [], set()
+            for column in added:
+                plan.append(('add_column', name, column.name))
+            for column in changed:
+                if 'alter_column' in driver.features:
+                    plan.append(('alter_column', name, column.name))
+            added = {c.name for c in added}
+            for column in table._columns:
+                if ((column.index or column.unique and column.name in added)
+                        and (column.name,) not in indexes):
+                    plan.append(('add_index', name, column.name))
+        return plan
+
+    def migrate(self, renames=None, chunk=1000):
+        """DB.migrate(renames=None, chunk=1000)
+
+        Alters database to match defined tables. See ``plan_migration`` for
+        the steps taken and the meaning of ``renames``. When a table must be
+        rebuilt, rows are copied ``chunk`` at a time, each chunk in its own
+        transaction."""
+        driver = self.__driver__
+        tables = dict(self._physical_tables())
+        for operation, name, *args in self.plan_migration(renames):
+            table = tables[name]
+            if operation == 'create_table':
+                self._create_table(table)
+            elif operation == 'rename_column':
+                driver._rename_column(name, args[1], args[0])
+            elif operation == 'add_column':
+                column = copy.copy(table._columns[args[0]])
+                # Not every database can add a column with a UNIQUE
+                # constraint, so uniqueness is added as an index instead
+                column.unique = False
+                driver._add_column(name, column)
+            elif operation == 'alter_column':
+                driver._alter_column(name, table._columns[args[0]])
+            elif operation == 'rebuild_table':
+                driver._rebuild_table(
+                    name, table._columns,
+                    [pk.name for pk in table.primarykey],
+                    [n for n, _, _, _ in driver._list_columns(name)
+                     if n in table._columns],
+                    chunk)
+                if table._fulltext:
+                    # Triggers were dropped with the old table
+                    driver._create_fulltext(
+                        name, table._fulltext, reindex=True)
+                if table._versioned:
+                    driver._create_versioning(
+                        name, self._versions_table()._name)
+                for aggregate in self:
+                    if (isinstance(aggregate, Aggregate) and
+                            aggregate._source._name == name):
+                        aggregate._create_triggers()
+                        aggregate.rebuild()
+            elif operation == 'add_index':
+                self._create_index(name, table._columns[args[0]])
 
 __all__.append('DB')
 
@@ -5,6 +5,12 @@ from . import sqlite
 __all__ = ['sqlite']
 
 
+# sharded spreads tables across databases of the other drivers
+
+from . import sharded
+__all__.append('sharded')
+
+
 # mysql driver depends on MySQLdb
 
 try:
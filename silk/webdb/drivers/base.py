@@ -7,7 +7,17 @@ from ... import container
 
 import datetime
 import errno
+import importlib
 import collections
+import contextlib
+import copy
+import io
+import os
+import random
+import time
+
+# Connections inherited across fork, kept open for the parent's sake
+_inherited = []
 
 rerrorcode = dict(zip(errno.errorcode.values(), errno.errorcode.keys()))
 
@@ -33,6 +43,38 @@ class SQLSyntaxError(Exception):
             '\n' + ' ' * self.offset + '^' if self.offset else '')
 
 
+class TransientError(Exception):
+    """Raised by drivers for errors which may not happen again if the
+    transaction is retried, like deadlocks and lost connections"""
+
+
+class blob(io.RawIOBase):
+    """Binary file which reads a value from the database in pieces,
+    using ``sql`` which selects ``size`` bytes starting at ``offset``
+    (counting from 1)"""
+    def __init__(self, driver, sql):
+        io.RawIOBase.__init__(self)
+        self.driver = driver
+        self.sql = sql
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        row = self.driver.execute(
+            self.sql, (self.offset + 1, len(buffer))).fetchone()
+        data = row[0] if row and row[0] else b''
+        buffer[:len(data)] = data
+        self.offset += len(data)
+        return len(data)
+
+
+class StatementTimeout(Exception):
+    """Raised by drivers when a statement is cancelled for taking too long.
+    See ``driver_base.time_limit``."""
+
+
 class AuthenticationError(Exception):
     def __init__(self, user, message=None):
         self.user = user
@@ -60,6 +102,8 @@ def parse(string):
         return string
 
 timestamp.parse = parse
+# Where pickle finds it, e.g. when columns are sent to worker processes
+parse.__qualname__ = 'timestamp.parse'
 
 del parse
 
@@ -77,13 +121,17 @@ class op(object):
         return isinstance(x, self.__class__)
 
 
+class valuelist(tuple):
+    """Values of an IN list, the operand of ``BELONGS``"""
+
+
 operator_names = {
     'EQUAL', 'NOTEQUAL', 'LESSTHAN', 'LESSEQUAL', 'GREATERTHAN',
     'GREATEREQUAL', 'ADD', 'CONCATENATE', 'SUBTRACT', 'MULTIPLY', 'DIVIDE',
     'FLOORDIVIDE', 'MODULO', 'AND', 'OR', 'NOT', 'NEGATIVE', 'ABS', 'LENGTH',
     'ASCEND', 'DESCEND', 'SUM', 'AVERAGE', 'BETWEEN', 'MIN', 'MAX', 'UPPER',
     'LOWER', 'LIKE', 'GLOB', 'LSTRIP', 'STRIP', 'RSTRIP', 'REPLACE', 'ROUND',
-    'SUBSTRING', 'COALESCE'
+    'SUBSTRING', 'COALESCE', 'COUNT', 'BELONGS', 'ROW', 'MATCH', 'RELEVANCE'
 }
 
 for name in operator_names:
@@ -149,10 +197,61 @@ class driver_base(object):
     The following methods may be defined by subclasses, but are not
     required for normal use.
 
+    list_indexes
+        list all indexes on a table. Implements: db.migrate
+    rename_column or rename_column_sql
+        changes a column's name. Implements: db.migrate
+    create_index, create_index_sql, create_index_if_nexists, or
+    create_index_if_nexists_sql
+        create indexes (if missing). Implements: db.define_table, db.migrate
+    alter_column or alter_column_sql
+        changes a column's definition. Drivers which define this should add
+        ``'alter_column'`` to ``features``. Otherwise they must define
+        rebuild_table. Implements: db.migrate
+    _rebuild_table
+        copies a table into a new definition. Implements: db.migrate
+    upsert or upsert_sql
+        inserts a row or updates the row with the same primary key. The
+        default uses sqlite's ``ON CONFLICT`` clause. Implements: table.upsert
+    insert_returning or insert_returning_sql
+        inserts a row and returns the stored values. Drivers which define
+        this should add ``'returning'`` to ``features``. Implements:
+        table.insert_returning
+
+    _bulk_load
+        context manager around loading many rows into a table. The default
+        does nothing. Implements: table.import_csv
+
+    snapshot and restore
+        copy the whole database and replace it with a copy. Implements:
+        db.snapshot, db.restore
+
+    _interrupt_after
+        context manager which cancels statements that take too long.
+        Implements: driver.time_limit, select(timeout=...)
+
+    open_blob or read_blob_sql
+        reads a value in pieces. The default selects substrings of the
+        value. Implements: table.open_blob
+
     drop_column or drop_column_sql
         removes a column and all its data from a table. Columns in a
         table which don't appear in a table definition are ignored.
         Implements: table.drop_column
+
+    create_trigger_sql and identical_sql
+        create triggers, with which _create_aggregate keeps aggregates up
+        to date. Implements: db.define_aggregate
+
+    _create_fulltext, _drop_fulltext, op_MATCH and op_RELEVANCE
+        maintain a full-text index of some columns of a table, and search
+        it. Implements: define_table(fulltext=...), Where.match,
+        Where.relevance
+
+    _shard_by
+        learns the column by which the rows of a table are spread across
+        databases. Only the sharded driver supports it. Implements:
+        define_table(shard_key=...)
     '''
 
     def __init__(self, connection, debug=False):
@@ -160,7 +259,9 @@ class driver_base(object):
 
         :``connection``: The DB-API compliant connection object.
             ``driver_base`` stores this as ``self.connection`` and uses it to
-            implement transaction support.
+            implement transaction support. It may be None if the driver
+            defines ``connect``, which then opens the connection when it's
+            first used.
 
         :``debug=False``: This parameter is optional, but must be allowed for
             the builtin test suite to function properly. Please consider
@@ -175,8 +276,8 @@ class driver_base(object):
 
         :``features``: This set tracks various optional features that database
             drivers might provide. Add or remove features as appropriate to
-            your database's abilities. As of this writing, ``'transactions'``
-            is the only supported value.
+            your database's abilities. Supported values are
+            ``'transactions'``, ``'alter_column'`` and ``'returning'``.
 
         In order for ``driver_base`` to function properly, it is important not
         to interfere with the instance attributes ``depth``, ``cursor``,
@@ -188,6 +289,9 @@ class driver_base(object):
         self.cursor = None
         self.debug = debug
         self.features = {'transactions'}
+        self.retry_stats = {'retries': 0, 'exhausted': 0}
+        self._time_limit = None
+        self._versioned = {}
 
     def __db_api_init__(self, module, *args, **kwargs):
         """Shortcut to __init__ for DB-API compliant databases
@@ -195,7 +299,8 @@ class driver_base(object):
         :``module``: Imported module object. Currently uses ``paramstyle``
             to generate proper SQL
 
-        Remaining arguments are passed to ``module``'s ``connect`` function.
+        Remaining arguments are passed to ``module``'s ``connect`` function
+        when the connection is first used.
         """
         self.parameters = {
             'qmark': self.parameters_qmark,
@@ -205,12 +310,85 @@ class driver_base(object):
             'numeric': self.parameters_numeric,
         }[module.paramstyle]
         debug = kwargs.pop('debug', False)
+        self._connect_args = (module, args, kwargs)
+        driver_base.__init__(self, None, debug=debug)
+
+    @property
+    def connection(self):
+        """The connection of the current process, opened on first use"""
+        if self._pid != os.getpid():
+            self._forked()
+        if self._connection is None:
+            self._connection = self.connect()
+            self._pid = os.getpid()
+        return self._connection
+
+    @connection.setter
+    def connection(self, connection):
+        self._connection = connection
+        self._pid = os.getpid()
+
+    def connect(self):
+        """Opens a new connection to the database. Drivers initialized with
+        ``__db_api_init__`` use its arguments."""
+        if not hasattr(self, '_connect_args'):
+            raise NotImplementedError(
+                '%s can not open new connections' % type(self).__name__)
+        module, args, kwargs = self._connect_args
         try:
-            connection = module.connect(*args, **kwargs)
+            return module.connect(*args, **kwargs)
         except Exception as e:
             self.handle_exception(e)
             raise
-        driver_base.__init__(self, connection, debug=debug)
+
+    def _forked(self):
+        """Called in a child process before it first uses the connection
+        inherited from its parent. Drivers which can reconnect forget it,
+        so that the child opens its own."""
+        if hasattr(self, '_connect_args') and self._connection is not None:
+            # Closing the connection would also end the parent's session
+            _inherited.append(self._connection)
+            self._connection = None
+        self._pid = os.getpid()
+        self.depth = 0
+        self.cursor = None
+
+    # Attributes which belong to one connection, left out of pickles
+    _unpickled = ('_connection', '_pid', 'depth', 'cursor')
+
+    def __getstate__(self):
+        """Drivers are pickled without their connection, e.g. to be sent
+        to worker processes, which connect again on first use. Like
+        ``clone``, this needs the arguments of ``__db_api_init__``."""
+        if not hasattr(self, '_connect_args'):
+            raise NotImplementedError(
+                '%s can not open new connections' % type(self).__name__)
+        state = {key: value for key, value in self.__dict__.items()
+                 if key not in self._unpickled}
+        module, args, kwargs = self._connect_args
+        state['_connect_args'] = (module.__name__, args, kwargs)
+        return state
+
+    def __setstate__(self, state):
+        module, args, kwargs = state.pop('_connect_args')
+        self.__dict__.update(state)
+        self._connect_args = (importlib.import_module(module), args, kwargs)
+        self.connection = None
+        self.depth = 0
+        self.cursor = None
+
+    def clone(self):
+        """Returns a copy of this driver with a connection of its own.
+
+        Used to give each worker of a parallel scan its own connection.
+        """
+        connection = self.connect()
+        other = copy.copy(self)
+        other.connection = connection
+        other.depth = 0
+        other.cursor = None
+        other.features = set(self.features)
+        return other
 
     def __enter__(self):
         """Transaction support.
@@ -221,6 +399,8 @@ class driver_base(object):
         wrapped in a with statement.
 
         """
+        if self._pid != os.getpid():
+            self._forked()
         self.depth += 1
         if self.cursor is None:
             self.cursor = self.connection.cursor()
@@ -258,17 +438,125 @@ class driver_base(object):
         scope. For example, creating an index can improve performance, but
         is not supported by ``webdb``. ``execute`` is also used internally
         to run all generated SQL statements. The most recent SQL statement
-        run is always available as ``lastsql``"""
+        run is always available as ``lastsql``. Statements outside a
+        transaction are retried after transient errors, see ``retry``."""
         self.lastsql = sql
         # print >>sys.stderr, sql, values or ''
+        return self.retry(self._execute, 'execute', sql, values)
+
+    def executemany(self, sql, values):
+        """Runs a single SQL statement once for each sequence in ``values``.
+
+        Used internally for bulk operations. Like ``execute``, the statement
+        is available as ``lastsql``"""
+        self.lastsql = sql
+        return self.retry(self._execute, 'executemany', sql, values)
+
+    def _execute(self, method, sql, values):
         with self as cursor:
             try:
-                cursor.execute(sql, values)
+                seconds = self._timeout()
+                with self._interrupt_after(self.connection,
+                                           seconds) as deadline:
+                    getattr(cursor, method)(sql, values)
+                    if seconds is not None:
+                        return self._buffered(cursor, deadline)
                 return cursor
             except Exception as e:
                 self.handle_exception(e)
                 raise Exception(e, sql, values)
 
+    statement_timeout = None
+
+    @contextlib.contextmanager
+    def time_limit(self, seconds):
+        """Statements executed in this context which take longer than
+        ``seconds`` are cancelled, raising ``StatementTimeout``. Outside
+        of it, ``statement_timeout`` limits statements if it isn't None.
+        """
+        previous = self._time_limit
+        self._time_limit = seconds
+        try:
+            yield
+        finally:
+            self._time_limit = previous
+
+    def _timeout(self):
+        if self._time_limit is not None:
+            return self._time_limit
+        return self.statement_timeout
+
+    @contextlib.contextmanager
+    def _apart(self):
+        """Statements executed in this context use a cursor of their own,
+        so that rows left to read from the transaction's cursor aren't
+        lost"""
+        cursor, self.cursor = self.cursor, None
+        try:
+            yield
+        finally:
+            self.cursor = cursor
+
+    def _buffered(self, cursor, deadline):
+        """Cursor holding the rows of ``cursor``, fetched while its
+        statement's time limit applies. ``deadline`` is the value of
+        ``_interrupt_after``'s context. Drivers whose cursors produce rows
+        lazily limit fetching them here."""
+        return cursor
+
+    @contextlib.contextmanager
+    def _interrupt_after(self, connection, seconds):
+        """Cancels statements run on ``connection`` in this context after
+        ``seconds``, unless it's None"""
+        if seconds is not None:
+            raise NotImplementedError(
+                '%s can not limit statement time' % type(self).__name__)
+        yield
+
+    retry_attempts = 5
+    retry_delay = 0.01
+    retry_max_delay = 1.0
+    retry_budget = 5.0
+
+    def retry(self, func, *args, **kwargs):
+        """Calls ``func`` in a transaction, and calls it again in a new
+        transaction if it raises ``TransientError``.
+
+        The delay before each retry doubles, starting from ``retry_delay``
+        up to ``retry_max_delay``, and is randomly shortened by up to half
+        so that competing clients don't retry in step. ``func`` is called
+        at most ``retry_attempts`` times, and not again once the delays add
+        up to ``retry_budget`` seconds. A transaction which is part of an
+        enclosing transaction isn't retried on its own, so retry the
+        outermost one. ``retry_stats`` counts retries, and errors raised
+        after running out of attempts.
+        """
+        if self.depth:
+            with self:
+                return func(*args, **kwargs)
+        return self._retrying(self._transaction, func, *args, **kwargs)
+
+    def _transaction(self, func, *args, **kwargs):
+        with self:
+            return func(*args, **kwargs)
+
+    def _retrying(self, func, *args, **kwargs):
+        """Calls ``func`` until it doesn't raise ``TransientError``, with
+        the delays and limits described by ``retry``"""
+        attempts, delay, waited = 1, self.retry_delay, 0.0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except TransientError:
+                wait = min(delay, self.retry_max_delay) * random.uniform(.5, 1)
+                if (attempts >= self.retry_attempts or
+                        waited + wait > self.retry_budget):
+                    self.retry_stats['exhausted'] += 1
+                    raise
+            self.retry_stats['retries'] += 1
+            time.sleep(wait)
+            attempts, delay, waited = attempts + 1, delay * 2, waited + wait
+
     def identifier(self, name):
         """Sanitize and format table and column names
 
@@ -281,38 +569,191 @@ class driver_base(object):
     def literal(self, value, cast=None):
         """Formats python values into equivalent SQL
 
-        The default implementation tunrs None into NULL and wraps text in
-        single-quotes."""
+        The default implementation tunrs None into NULL, bytes into hex
+        blobs, and wraps text and dates in single-quotes."""
         if value is None:
             return 'NULL'
+        elif isinstance(value, bytes):
+            return "X'%s'" % value.hex()
         elif isinstance(value, str) or cast in ('TEXT', 'BLOB'):
             return "'%s'" % str(value).replace("'", "''")
+        elif isinstance(value, (datetime.datetime, datetime.date,
+                                datetime.time)):
+            return "'%s'" % value
         elif cast in ('INT', 'REAL'):
             return '%g' % value
         else:
             return value
 
-    def expression(self, x):
-        if isinstance(x, list):
-            operator = getattr(self, 'op_%s' % x[0])
-            return '(%s)' % operator(*map(self.expression, x[1:]))
-        elif hasattr(x, 'table') and hasattr(x, 'name'):  # Column duck-typed
-            return '%s.%s' % (self.identifier(x.table._name),
-                              self.identifier(x.name))
-        elif hasattr(x, '_where_tree'):  # Where, duck-typed
-            return self.expression(x._where_tree)
-        else:
-            return self.literal(x)
+    # Binding strength of operators, as (level, operand level). An operand
+    # is parenthesized if its level is below the operand level of the
+    # operator using it, or equal unless both are the same associative
+    # operator. Operators which aren't listed (functions) and values have
+    # level ATOM. Prefix operators parenthesize anything but values.
+    ATOM = 100
+    precedence = {
+        'OR': (1, 1), 'AND': (2, 2), 'NOT': (3, ATOM),
+        'EQUAL': (4, 5), 'NOTEQUAL': (4, 5), 'LESSTHAN': (4, 5),
+        'LESSEQUAL': (4, 5), 'GREATERTHAN': (4, 5), 'GREATEREQUAL': (4, 5),
+        'LIKE': (4, 5), 'GLOB': (4, 5), 'BETWEEN': (4, 5), 'BELONGS': (4, 5),
+        'MATCH': (4, 5),
+        'ADD': (6, 6), 'SUBTRACT': (6, 6), 'MULTIPLY': (7, 7),
+        'DIVIDE': (7, 7), 'FLOORDIVIDE': (7, 7), 'MODULO': (7, 7),
+        'CONCATENATE': (8, 8), 'NEGATIVE': (0, ATOM),
+        'ASCEND': (0, 0), 'DESCEND': (0, 0),
+    }
+    associative = {'OR', 'AND', 'ADD', 'MULTIPLY', 'CONCATENATE'}
+    # Chains of an associative operator longer than this are split into
+    # parenthesized halves, so databases parse them as balanced trees
+    chain_length = 32
+
+    # Most values bound as parameters in one statement
+    max_parameters = 999
+
+    # Whether primary key columns can hold NULL
+    null_primarykeys = True
+
+    def expression(self, x, parameters=None, renamed=None):
+        """Formats an expression tree as SQL
+
+        The tree is walked iteratively, so deeply nested conditions don't
+        reach Python's recursion limit. Subtrees which appear several times
+        are only formatted once, and the SQL of each column is kept on it.
+
+        While walking, each node becomes a tuple of (sql, level, operator).
+        Chains of an associative operator are formatted once their last
+        operand is known; until then sql is None and the tuple also holds
+        both operands.
+
+        If ``parameters`` is a list, the values of IN lists are bound as
+        parameters, which are appended to it in order, as long as the
+        statement stays within ``max_parameters``. Otherwise values are
+        formatted as literals.
+
+        Columns of tables named in the dict ``renamed`` are qualified with
+        the name it maps them to, e.g. the partition being updated.
+        """
+        memo = {}
+        results = []
+        stack = [(x, None)]
+        while stack:
+            node, start = stack.pop()
+            if start is not None:
+                name = '%s' % node[0]
+                args = results[len(results) - len(node) + 1:]
+                del results[len(results) - len(node) + 1:]
+                if name in self.associative and len(args) == 2:
+                    result = (None, self.precedence.get(
+                        name, (self.ATOM, 0))[0], name) + tuple(args)
+                else:
+                    result = self._operation(name, args)
+                memo[id(node)] = result, (
+                    parameters[start:] if parameters else [])
+                results.append(result)
+            elif isinstance(node, list):
+                if id(node) in memo:
+                    result, bound = memo[id(node)]
+                    if bound:
+                        parameters.extend(bound)
+                    results.append(result)
+                elif (repr(node[0]) == 'BELONGS' and
+                        isinstance(node[2], valuelist) and not node[2]):
+                    # Nothing belongs to an empty list, not even NULL
+                    results.append(
+                        ('0 = 1', self.precedence['EQUAL'][0], 'EQUAL'))
+                else:
+                    stack.append((node, len(parameters or ())))
+                    stack.extend((arg, None) for arg in reversed(node[1:]))
+            elif hasattr(node, '_where_tree') and not hasattr(node, 'table'):
+                stack.append((node._where_tree, None))
+            elif isinstance(node, valuelist):
+                results.append(self._valuelist(node, parameters))
+            elif hasattr(node, '_subselect'):  # Subselect, duck-typed
+                results.append(('(%s)' % self.select_sql(*self._select_args(
+                    *node._subselect, parameters=parameters)).rstrip(';'),
+                    self.ATOM, None))
+            else:
+                results.append(self.atom(node, renamed))
+        return self._chain_sql(results[0])
 
-    def where_clause(self, where):
+    def _valuelist(self, values, parameters):
+        if parameters is None or \
+                len(parameters) + len(values) > self.max_parameters:
+            sql = ', '.join('%s' % self.literal(v) for v in values)
+        else:
+            parameters.extend(values)
+            sql = ', '.join(self.parameters(values))
+        return '(%s)' % sql, self.ATOM, None
+
+    def _operation(self, name, args):
+        """Applies operator ``name`` to the walked nodes ``args``"""
+        level, operand = self.precedence.get(name, (self.ATOM, 0))
+        return getattr(self, 'op_%s' % name)(*(
+            '(%s)' % sql if (
+                arg_level < operand or arg_level == operand and not (
+                    arg_name == name and name in self.associative))
+            else sql
+            for sql, arg_level, arg_name in (
+                (self._chain_sql(arg), arg[1], arg[2]) for arg in args)
+        )), level, name
+
+    def _chain_sql(self, result):
+        if result[0] is not None:
+            return result[0]
+        name = result[2]
+        terms, stack = [], [result]
+        while stack:
+            term = stack.pop()
+            if term[0] is None and term[2] == name:
+                stack.extend((term[4], term[3]))
+            else:
+                terms.append(term)
+        return self._join(name, terms)[0]
+
+    def _join(self, name, terms):
+        if len(terms) > self.chain_length:
+            half = len(terms) // 2
+            return self._operation(name, [
+                self._join(name, terms[:half])[:1] + (0, None),
+                self._join(name, terms[half:])[:1] + (0, None),
+            ])
+        result = terms[0]
+        for term in terms[1:]:
+            result = self._operation(name, [result, term])
+        return result
+
+    def atom(self, x, renamed=None):
+        """Formats a value or column, returning (sql, level, None)"""
+        if hasattr(x, 'table') and hasattr(x, 'name'):  # Column duck-typed
+            if renamed and x.table._name in renamed:
+                return '%s.%s' % (self.identifier(renamed[x.table._name]),
+                                  self.identifier(x.name)), self.ATOM, None
+            # Kept on the column, so it goes along with the column
+            key = (self.id_quote, x.table._name, x.name)
+            cached = getattr(x, '_sql', None)
+            if cached is None or cached[0] != key:
+                cached = x._sql = (key, '%s.%s' % (
+                    self.identifier(x.table._name), self.identifier(x.name)))
+            return cached[1], self.ATOM, None
+        value = self.literal(x)
+        # Negative numbers bind like NEGATIVE, i.e. a - -1 isn't a comment
+        negative = isinstance(value, (int, float)) and value < 0
+        return '%s' % value, 0 if negative else self.ATOM, None
+
+    def where_clause(self, where, parameters=None, renamed=None):
         if where:
-            clause = self.expression(where)
+            clause = self.expression(where, parameters, renamed)
             if clause:
                 clause = ' WHERE '+clause
         else:
             clause = ''
         return clause
 
+    def having_clause(self, having, parameters=None):
+        if having is None:
+            return ''
+        return ' HAVING ' + self.expression(having, parameters)
+
     def parameters_qmark(self, columns):
         return ['?' for c in columns]
 
@@ -330,7 +771,7 @@ class driver_base(object):
 
     def normalize_column(self, column):
         r = container(vars(column))
-        r.type = self.map_type(r.native_type)
+        r.type = self.map_type(bytes if r.compressed else r.native_type)
         if r.type is None:
             raise Exception('Unknown column type %s' % r.native_type)
         r.hasdefault = (
@@ -392,6 +833,191 @@ class driver_base(object):
     def add_column_sql(self, table, column):
         return """ALTER TABLE %s ADD COLUMN %s;""" % (table, column)
 
+    def _rename_column(self, table, column, name):
+        self.rename_column(self.identifier(table), self.identifier(column),
+                           self.identifier(name))
+
+    def rename_column(self, table, column, name):
+        self.execute(self.rename_column_sql(table, column, name))
+
+    def rename_column_sql(self, table, column, name):
+        return """ALTER TABLE %s RENAME COLUMN %s TO %s;""" % (
+            table, column, name)
+
+    def _alter_column(self, table, column):
+        self.alter_column(self.identifier(table), self.format_column(column))
+
+    def alter_column(self, table, column):
+        self.execute(self.alter_column_sql(table, column))
+
+    def alter_column_sql(self, table, column):
+        raise NotImplementedError
+
+    def _list_indexes(self, table):
+        return self.list_indexes(self.identifier(table))
+
+    def list_indexes(self, table):
+        raise NotImplementedError
+
+    def _create_index(self, table, name, columns, unique=False):
+        """Sanitize data from DB and call create_index_if_nexists"""
+        return self.create_index_if_nexists(
+            self.identifier(table),
+            self.identifier(name),
+            list(map(self.identifier, columns)),
+            bool(unique),
+        )
+
+    def create_index_if_nexists(self, table, name, columns, unique):
+        try:
+            self.execute(self.create_index_if_nexists_sql(
+                table, name, columns, unique))
+        except NotImplementedError:
+            if name not in [self.identifier(n) for n, _, _ in
+                            self.list_indexes(table)]:
+                self.create_index(table, name, columns, unique)
+
+    def create_index_if_nexists_sql(self, table, name, columns, unique):
+        raise NotImplementedError
+
+    def create_index(self, table, name, columns, unique):
+        self.execute(self.create_index_sql(table, name, columns, unique))
+
+    def create_index_sql(self, table, name, columns, unique):
+        return """CREATE%s INDEX %s ON %s(%s);""" % (
+            ' UNIQUE' if unique else '', name, table, ', '.join(columns))
+
+    def _rebuild_table(self, table, columns, primarykeys, copied, chunk):
+        """Recreate ``table`` with new ``columns``, keeping the values of the
+        columns named in ``copied``. Used by drivers without 'alter_column'
+        """
+        raise NotImplementedError
+
+    def identical_sql(self, a, b):
+        """Compares ``a`` and ``b``, where NULL is identical to NULL"""
+        return '%s IS %s' % (a, b)
+
+    def create_trigger_sql(self, name, event, table, body):
+        return """CREATE TRIGGER %s AFTER %s ON %s FOR EACH ROW
+            BEGIN %s END;""" % (name, event, table, body)
+
+    def drop_trigger_sql(self, name):
+        return """DROP TRIGGER IF EXISTS %s;""" % name
+
+    def _create_aggregate(self, name, source, groupby, sums):
+        """(Re)creates triggers which keep ``name`` up to date with the sums
+        of ``sums`` and the count of rows in ``source``, grouped by
+        ``groupby``. Groups are matched with ``identical_sql``, so NULL is a
+        group like any other, and removed when their last row is.
+        """
+        self._drop_aggregate(name)
+        trigger = '%s_%%s' % name
+        name = self.identifier(name)
+        groupby = list(map(self.identifier, groupby))
+        sums = list(map(self.identifier, sums))
+        rows = self.identifier('rows')
+
+        def group(row):
+            return ' AND '.join(
+                self.identical_sql(c, '%s.%s' % (row, c))
+                for c in groupby) or '1 = 1'
+
+        def change(row, sign):
+            return """UPDATE %s SET %s WHERE %s;""" % (name, ', '.join(
+                ['%s = %s %s coalesce(%s.%s, 0)' % (c, c, sign, row, c)
+                 for c in sums] + ['%s = %s %s 1' % (rows, rows, sign)]
+            ), group(row))
+
+        insert = change('new', '+') + (
+            """INSERT INTO %s(%s) SELECT %s FROM (SELECT 1) AS one
+               WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s);""" % (
+                name, ', '.join(groupby + sums + [rows]), ', '.join(
+                    ['new.%s' % c for c in groupby] +
+                    ['coalesce(new.%s, 0)' % c for c in sums] + ['1']),
+                name, group('new')))
+        delete = change('old', '-') + (
+            """DELETE FROM %s WHERE %s AND %s = 0;""" % (
+                name, group('old'), rows))
+        for event, body in (('INSERT', insert), ('DELETE', delete),
+                            ('UPDATE', delete + insert)):
+            self.execute(self.create_trigger_sql(
+                self.identifier(trigger % event.lower()),
+                event, self.identifier(source), body))
+
+    def _drop_aggregate(self, name):
+        for event in ('insert', 'delete', 'update'):
+            self.execute(self.drop_trigger_sql(
+                self.identifier('%s_%s' % (name, event))))
+
+    def _create_versioning(self, table, versions):
+        """Adds one to the ``version`` of the row of ``versions`` named
+        ``table`` after each statement which writes to ``table``, in the
+        same transaction"""
+        for event in ('insert', 'delete', 'update'):
+            # Left by versions which counted changes per row
+            self.execute(self.drop_trigger_sql(
+                self.identifier('%s_version_%s' % (table, event))))
+        self._versioned[table] = versions
+
+    def _write(self, table, func, *args):
+        """Calls ``func``, which writes to ``table``. Writes to versioned
+        tables also add one to the table's version, in the same
+        transaction, and the two are retried together."""
+        versions = self._versioned.get(table)
+        if versions is None:
+            return func(*args)
+        return self.retry(self._bumped, table, versions, func, *args)
+
+    def _bumped(self, table, versions, func, *args):
+        # Before the statement, which may have rows left to read from the
+        # transaction's cursor
+        self.execute(self.bump_version_sql(
+            self.identifier(versions), *self.parameters(['name'])), [table])
+        return func(*args)
+
+    def bump_version_sql(self, versions, name):
+        return """UPDATE %s SET version = version + 1 WHERE name = %s;""" % (
+            versions, name)
+
+    def _rebuild_aggregate(self, name, source, groupby, sums):
+        name, source = self.identifier(name), self.identifier(source)
+        groupby = list(map(self.identifier, groupby))
+        sums = list(map(self.identifier, sums))
+        with self:
+            self.execute("""DELETE FROM %s;""" % name)
+            self.execute("""INSERT INTO %s(%s) SELECT %s FROM %s%s;""" % (
+                name, ', '.join(groupby + sums + [self.identifier('rows')]),
+                ', '.join(groupby +
+                          ['coalesce(sum(%s), 0)' % c for c in sums] +
+                          ['count(*)']),
+                source,
+                ' GROUP BY %s' % ', '.join(groupby) if groupby else ''))
+
+    def _create_fulltext(self, table, columns, reindex=False):
+        """Creates a full-text index of ``columns`` in ``table`` if it's
+        missing. Rows already in the table are indexed when the index is
+        created, or if ``reindex`` is true."""
+        raise NotImplementedError(
+            'Full-text search is not supported by this driver')
+
+    def _drop_fulltext(self, table):
+        """Removes anything ``_create_fulltext`` made which isn't dropped
+        with ``table``"""
+
+    def op_MATCH(self, column, query):
+        raise NotImplementedError(
+            'Full-text search is not supported by this driver')
+
+    def op_RELEVANCE(self, column, query):
+        raise NotImplementedError(
+            'Full-text search is not supported by this driver')
+
+    def _shard_by(self, table, column):
+        """Spreads the rows of ``table`` across databases by the value of
+        ``column``"""
+        raise NotImplementedError(
+            '%s does not shard tables' % type(self).__name__)
+
     def _drop_column(self, table, column):
         self.drop_column(self.identifier(table), self.identifier(column))
 
@@ -432,13 +1058,36 @@ class driver_base(object):
     def create_table(self, name, columns, primarykeys):
         self.execute(self.create_table_sql(name, columns, primarykeys))
 
-    def _delete(self, table, conditions):
+    def aliased(self, table, alias=None):
+        """Formats ``table``, renamed ``alias`` if that's a different name.
+        Used for partitions, which queries refer to by their table's name.
+        """
+        if alias is None or alias == table:
+            return self.identifier(table)
+        return '%s AS %s' % (self.identifier(table), self.identifier(alias))
+
+    def table_sql(self, table, conditions):
+        """Formats ``table`` for a FROM clause. Tables stored in partitions
+        read the union of those which might match ``conditions``."""
+        names = table._targets(conditions)
+        if len(names) == 1:
+            return self.aliased(names[0], table._name)
+        return '(%s) AS %s' % (' UNION ALL '.join(
+            'SELECT * FROM %s' % self.identifier(name) for name in names
+        ), self.identifier(table._name))
+
+    def _delete(self, table, conditions, alias=None):
         """Sanitize data from DB and call delete"""
-        return self.delete(self.identifier(table),
-                           self.where_clause(conditions))
+        values = []
+        # Older MySQL versions can't alias the table of an UPDATE or DELETE
+        renamed = {alias: table} if alias else None
+        return self._write(
+            alias or table, self.delete,
+            self.identifier(table),
+            self.where_clause(conditions, values, renamed), values)
 
-    def delete(self, table, conditions):
-        return self.execute(self.delete_sql(table, conditions))
+    def delete(self, table, conditions, values=()):
+        return self.execute(self.delete_sql(table, conditions), values)
 
     def delete_sql(self, table, where):
         return """DELETE FROM %s%s;""" % (table, where)
@@ -454,7 +1103,8 @@ class driver_base(object):
 
     def _insert(self, table, columns, values):
         """Sanitize data from DB and call insert"""
-        return self.insert(
+        return self._write(
+            table, self.insert,
             self.identifier(table),
             [self.identifier(x) for x in columns],
             self.parameters(columns),
@@ -472,37 +1122,159 @@ class driver_base(object):
     def insert_rowid(self, cur):
         return cur.lastrowid
 
-    def _select(self, columns, tables, conditions, distinct, orderby):
-        """Sanitize data from DB and call select"""
-        return self.select(
-            [self.expression(x) for x in columns],
-            [self.identifier(t._name) for t in tables],
-            self.where_clause(conditions),
-            bool(distinct),
-            [pstrip(self.expression(o)) for o in orderby],
-        )
+    def _insert_many(self, table, columns, rows):
+        """Sanitize data from DB and call insert_many"""
+        return self._write(
+            table, self.insert_many,
+            self.identifier(table),
+            [self.identifier(x) for x in columns],
+            self.parameters(columns),
+            rows)
 
-    def select(self, columns, tables, where, distinct, orderby):
+    def insert_many(self, table, columns, placeholders, rows):
+        return self.executemany(
+            self.insert_sql(table, columns, placeholders), rows)
+
+    def snapshot(self, path=None):
+        raise NotImplementedError
+
+    def restore(self, snapshot):
+        raise NotImplementedError
+
+    def _open_blob(self, table, column, conditions):
+        """Sanitize data from DB and call open_blob"""
+        return self.open_blob(self.identifier(table),
+                              self.identifier(column),
+                              self.where_clause(conditions))
+
+    def open_blob(self, table, column, where):
+        return blob(self, self.read_blob_sql(
+            table, column, where, *self.parameters(['offset', 'size'])))
+
+    def read_blob_sql(self, table, column, where, offset, size):
+        return """SELECT SUBSTR(%s, %s, %s) FROM %s%s;""" % (
+            column, offset, size, table, where)
+
+    @contextlib.contextmanager
+    def _bulk_load(self, table):
+        """Prepare ``table`` for loading many rows"""
+        yield
+
+    def _insert_returning(self, table, columns, values, returning):
+        """Sanitize data from DB and call insert_returning"""
+        return self._write(
+            table, self.insert_returning,
+            self.identifier(table),
+            [self.identifier(x) for x in columns],
+            self.parameters(columns),
+            values,
+            [self.identifier(x) for x in returning])
+
+    def insert_returning(self, table, columns, placeholders, values,
+                         returning):
         return self.execute(
-            self.select_sql(columns, tables, where, distinct, orderby))
+            self.insert_returning_sql(table, columns, placeholders,
+                                      returning),
+            values)
 
-    def select_sql(self, columns, tables, where, distinct, orderby):
-        return """SELECT%s %s FROM %s%s%s;""" % (
+    def insert_returning_sql(self, table, columns, values, returning):
+        return """INSERT INTO %s(%s) VALUES (%s) RETURNING %s""" % (
+            table, ','.join(columns), ','.join(values), ','.join(returning))
+
+    def _upsert(self, table, columns, keys, values):
+        """Sanitize data from DB and call upsert"""
+        return self._write(
+            table, self.upsert,
+            self.identifier(table),
+            [self.identifier(x) for x in columns],
+            self.parameters(columns),
+            [self.identifier(x) for x in keys],
+            [self.identifier(x) for x in columns if x not in keys],
+            values)
+
+    def upsert(self, table, columns, placeholders, keys, updates, values):
+        return self.execute(
+            self.upsert_sql(table, columns, placeholders, keys, updates),
+            values)
+
+    def upsert_sql(self, table, columns, values, keys, updates):
+        return """INSERT INTO %s(%s) VALUES (%s) ON CONFLICT(%s) %s""" % (
+            table, ','.join(columns), ','.join(values), ','.join(keys),
+            'DO UPDATE SET %s' % ', '.join(
+                '%s=excluded.%s' % (c, c) for c in updates)
+            if updates else 'DO NOTHING')
+
+    def _upsert_many(self, table, columns, keys, rows):
+        """Sanitize data from DB and call upsert_many"""
+        return self._write(
+            table, self.upsert_many,
+            self.identifier(table),
+            [self.identifier(x) for x in columns],
+            self.parameters(columns),
+            [self.identifier(x) for x in keys],
+            [self.identifier(x) for x in columns if x not in keys],
+            rows)
+
+    def upsert_many(self, table, columns, placeholders, keys, updates, rows):
+        return self.executemany(
+            self.upsert_sql(table, columns, placeholders, keys, updates),
+            rows)
+
+    def _select(self, columns, tables, conditions, distinct, orderby,
+                groupby=(), having=None, limit=None):
+        """Sanitize data from DB and call select"""
+        values = []
+        return self.select(*self._select_args(
+            columns, tables, conditions, distinct, orderby, groupby, having,
+            limit, values), values=values)
+
+    def _select_compiled(self, sql, values, args):
+        """Runs ``sql`` with the parameters ``values``, compiled by
+        ``select_sql`` from the ``_select`` arguments ``args``"""
+        return self.execute(sql, values)
+
+    def _select_args(self, columns, tables, conditions, distinct, orderby,
+                     groupby=(), having=None, limit=None, parameters=None):
+        # Formatted in the order of the statement, for bound parameters
+        columns = [self.expression(x, parameters) for x in columns]
+        tables = [self.table_sql(t, conditions) for t in tables]
+        where = self.where_clause(conditions, parameters)
+        groupby = [self.expression(g, parameters) for g in groupby]
+        having = self.having_clause(having, parameters)
+        orderby = [self.expression(o, parameters) for o in orderby]
+        return (columns, tables, where, bool(distinct), orderby, groupby,
+                having, None if limit is None else int(limit))
+
+    def select(self, columns, tables, where, distinct, orderby, groupby=(),
+               having='', limit=None, values=()):
+        return self.execute(self.select_sql(
+            columns, tables, where, distinct, orderby, groupby, having,
+            limit), values)
+
+    def select_sql(self, columns, tables, where, distinct, orderby,
+                   groupby=(), having='', limit=None):
+        return """SELECT%s %s FROM %s%s%s%s%s%s;""" % (
             ' DISTINCT' if distinct else '',
             ', '.join(columns),
             ', '.join(tables),
             where,
+            ' GROUP BY %s' % ', '.join(groupby) if groupby else '',
+            having,
             ' ORDER BY %s' % ', '.join(orderby) if orderby else '',
+            ' LIMIT %i' % limit if limit is not None else '',
         )
 
-    def _update(self, table, conditions, values):
+    def _update(self, table, conditions, values, alias=None):
         """Sanitize data from DB and call update"""
-        return self.update(
+        bound = list(values.values())
+        renamed = {alias: table} if alias else None
+        return self._write(
+            alias or table, self.update,
             self.identifier(table),
             [self.identifier(x) for x in values.keys()],
-            self.where_clause(conditions),
+            self.where_clause(conditions, bound, renamed),
             self.parameters(values.keys()),
-            list(values.values()),
+            bound,
         )
 
     def update(self, table, columns, where, parameters, values):
@@ -545,6 +1317,9 @@ class driver_base(object):
         a, b, c))
     op_MIN = staticmethod(lambda a: 'min(%s)' % a)
     op_MAX = staticmethod(lambda a: 'max(%s)' % a)
+    op_COUNT = staticmethod(lambda a: 'count(%s)' % a)
+    op_BELONGS = staticmethod(lambda a, b: '%s IN %s' % (a, b))
+    op_ROW = staticmethod(lambda *a: '(%s)' % ', '.join(a))
     op_UPPER = staticmethod(lambda a: 'upper(%s)' % a)
     op_LOWER = staticmethod(lambda a: 'lower(%s)' % a)
     op_LIKE = staticmethod(lambda a, b, c=None: '%s LIKE %s' % (
@@ -1,12 +1,28 @@
 
 from . import base
 
+import collections
+import contextlib
 import datetime
+import threading
 import warnings
 
 import MySQLdb
 
 
+class statement(object):
+    """Statement run under a time limit, which may be cancelled until it
+    ends"""
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.lock = threading.Lock()
+
+    def end(self):
+        """Waits for any cancellation in progress, and prevents others"""
+        with self.lock:
+            self.thread_id = None
+
+
 class mysql(base.driver_base):
     """Driver for mysql databases
 
@@ -33,6 +49,8 @@ class mysql(base.driver_base):
     }
 
     id_quote = '`'
+    max_parameters = 65535
+    null_primarykeys = False
 
     def __init__(self, database, user='root', password=None, host='localhost',
                  engine='MyISAM', debug=False):
@@ -44,6 +62,7 @@ class mysql(base.driver_base):
             db=database, debug=debug
         )
         self.engine = engine
+        self.features.add('alter_column')
 
     @property
     def engine(self):
@@ -67,6 +86,12 @@ class mysql(base.driver_base):
         datetime.datetime: 'DATETIME',
     }
 
+    def literal(self, value, cast=None):
+        # Backslashes escape characters in MySQL's strings
+        if isinstance(value, str):
+            value = value.replace('\\', '\\\\')
+        return base.driver_base.literal(self, value, cast)
+
     def handle_exception(self, e):
         if isinstance(e, MySQLdb.OperationalError):
             code = e.args[0]
@@ -77,6 +102,14 @@ class mysql(base.driver_base):
                 raise base.AuthenticationError(self.user)
             elif code == 1054:
                 raise KeyError(e.args[1])
+            elif code in (1317, 3024):
+                raise base.StatementTimeout(
+                    'Statement took too long: %s' % self.lastsql)
+            elif code in (1205, 1213, 2006, 2013):
+                if code in (2006, 2013):
+                    # The server closed the connection, so open a new one
+                    self.connection = None
+                raise base.TransientError(e.args[1])
         elif isinstance(e, MySQLdb.IntegrityError):
             code = e.args[0]
             if code == 1062:
@@ -105,6 +138,44 @@ class mysql(base.driver_base):
                 raise Exception('Unknown column type %s' % v_type)
             yield (str(name), ut, null != 'YES', default)
 
+    def list_indexes(self, table):
+        indexes = collections.OrderedDict()
+        for row in self.execute("""SHOW INDEX FROM %s;""" % table).fetchall():
+            _, non_unique, name, _, column = row[:5]
+            indexes.setdefault(name, (not non_unique, []))[1].append(column)
+        for name, (unique, columns) in indexes.items():
+            yield (str(name), unique, [str(c) for c in columns])
+
+    def _create_fulltext(self, table, columns, reindex=False):
+        """Each column gets its own FULLTEXT index, so ``MATCH`` can search
+        any one of them. InnoDB keeps them up to date itself."""
+        existing = {name for name, _, _ in
+                    self.list_indexes(self.identifier(table))}
+        for column in columns:
+            name = '%s_%s_fulltext' % (table, column)
+            if name not in existing:
+                self.execute("""CREATE FULLTEXT INDEX %s ON %s(%s);""" % (
+                    self.identifier(name), self.identifier(table),
+                    self.identifier(column)))
+
+    def identical_sql(self, a, b):
+        return '%s <=> %s' % (a, b)
+
+    op_MATCH = staticmethod(
+        lambda a, b: 'MATCH (%s) AGAINST (%s IN NATURAL LANGUAGE MODE)' % (
+            a, b))
+    op_RELEVANCE = op_MATCH
+
+    def upsert_sql(self, table, columns, values, keys, updates):
+        # Conflicts on any unique column update the row, not just on keys
+        return """INSERT INTO %s(%s) VALUES (%s)
+                  ON DUPLICATE KEY UPDATE %s""" % (
+            table, ','.join(columns), ','.join(values), ', '.join(
+                '%s=VALUES(%s)' % (c, c) for c in updates or keys[:1]))
+
+    def alter_column_sql(self, table, column):
+        return """ALTER TABLE %s MODIFY COLUMN %s;""" % (table, column)
+
     def create_table_if_nexists(self, name, columns, primarykeys):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
@@ -119,8 +190,47 @@ class mysql(base.driver_base):
                     self.engine)
             )
 
+    @contextlib.contextmanager
+    def _interrupt_after(self, connection, seconds):
+        if seconds is None:
+            yield
+            return
+        running = statement(connection.thread_id())
+        timer = threading.Timer(seconds, self._kill_query, (running,))
+        timer.daemon = True
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.cancel()
+            running.end()
+
+    def _kill_query(self, running):
+        """Cancels the statement ``running`` on another connection, unless
+        it has ended"""
+        connection = self.connect()
+        try:
+            # Held while killing, so the connection can't move on to its
+            # next statement meanwhile
+            with running.lock:
+                if running.thread_id is not None:
+                    connection.cursor().execute(
+                        """KILL QUERY %i;""" % running.thread_id)
+        finally:
+            connection.close()
+
+    def _create_aggregate(self, name, source, groupby, sums):
+        if self.debug:
+            raise NotImplementedError(
+                "Aggregate tables need triggers, which the temporary tables"
+                " of debug mode can't have")
+        return base.driver_base._create_aggregate(
+            self, name, source, groupby, sums)
+
     def insert_rowid(self, cursor):
         return self.connection.insert_id()
 
     op_SUM = staticmethod(lambda a: 'sum(%s)' % a)
     op_CONCATENATE = staticmethod(lambda a, b: 'CONCAT(%s,%s)' % (a, b))
+    precedence = {k: v for k, v in base.driver_base.precedence.items()
+                  if k != 'CONCATENATE'}
@@ -0,0 +1,504 @@
+
+from . import base
+
+import collections
+import concurrent.futures
+import contextlib
+import heapq
+import itertools
+import os
+import threading
+import zlib
+
+
+class result(object):
+    """Rows gathered from several shards, read like a cursor"""
+    description = None
+    lastrowid = None
+
+    def __init__(self, rows, rowcount=-1):
+        self.rows = collections.deque(rows)
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self.rows.popleft() if self.rows else None
+
+    def fetchmany(self, size=1):
+        return [self.rows.popleft() for _ in range(min(size, len(self.rows)))]
+
+    def fetchall(self):
+        rows, self.rows = list(self.rows), collections.deque()
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+
+class order(object):
+    """Sort key for rows merged from several shards, given the values of
+    their ORDER BY expressions. NULLs come first in ascending order, as in
+    sqlite and mysql."""
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __lt__(self, other):
+        for a, b, descending in zip(self.values, other.values,
+                                    self.descending):
+            if a == b:
+                continue
+            if a is None:
+                less = True
+            elif b is None:
+                less = False
+            else:
+                less = a < b
+            return less != descending
+        return False
+
+
+def _add(a, b):
+    return b if a is None else a if b is None else a + b
+
+
+def _least(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _greatest(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+aggregates = {'COUNT', 'SUM', 'MIN', 'MAX', 'AVERAGE'}
+
+# How the value of each aggregate is combined from the shards' values
+combiners = {
+    'COUNT': _add,
+    'SUM': _add,
+    'MIN': _least,
+    'MAX': _greatest,
+}
+
+
+class sharded(object):
+    """Driver which spreads the rows of tables across several databases,
+    the shards, each with a driver of its own.
+
+    Tables defined with ``shard_key=column`` store each row on the shard
+    chosen by hashing its value of ``column``, which must be part of the
+    primary key and can't be updated. Other tables are stored on the first
+    shard. Inserts, and any statement whose conditions fix the shard key
+    to one or a few values, only run on the shards which hold those rows.
+    Other selects run on every shard, in parallel threads when the shards
+    can open connections for them, and their rows are merged: ORDER BY
+    and LIMIT apply to the merged rows, and COUNT, SUM, MIN and MAX are
+    combined for each group. Averages and ``having`` can't be combined.
+    Set ``parallel`` to False to read the shards one after another.
+
+    Each shard keeps its own schema, updated together, and commits its
+    own transactions, so a ``with`` block which writes to several shards
+    isn't atomic. Joins only match rows stored on the same shard. Aggregate
+    tables, versioned tables and snapshots aren't supported.
+
+    >>> shards = [DB.connect('sqlite'), DB.connect('sqlite')]
+    >>> mydb = DB.connect('sharded', shards)
+    >>> mydb.define_table('test_sharded', StrColumn('name', primarykey=True),
+    ...                   IntColumn('value'), shard_key='name')
+    >>> t = mydb.test_sharded
+    >>> t.insert_many(*(dict(name=c, value=i) for i, c in enumerate('abcd')))
+    >>> [shard.execute('SELECT count(*) FROM test_sharded').fetchone()[0]
+    ...  for shard in shards]
+    [1, 3]
+    >>> [row.name for row in t.select(orderby=reversed(t.value), limit=3)]
+    ['d', 'c', 'b']
+    >>> [tuple(row) for row in t.select(t.value.sum(), t.name.tally())]
+    [(6, 4)]
+    """
+    def __init__(self, shards, debug=False):
+        if not shards:
+            raise ValueError('Sharded databases need at least one shard')
+        self.shards = [getattr(shard, '__driver__', shard) for shard in shards]
+        self.debug = debug
+        self.shard_keys = {}
+        self.parallel = True
+        self._executor = None
+        self._pid = None
+
+    # Formatting, features and schema, which are the same on every shard
+    delegated = frozenset([
+        'features', 'lastsql', 'list_tables', '_list_columns',
+        '_list_indexes', 'select_sql', '_select_args', 'retry_stats',
+        'null_primarykeys',
+    ])
+
+    def __getattr__(self, key):
+        if key not in self.delegated:
+            raise AttributeError(key)
+        return getattr(self.shards[0], key)
+
+    @property
+    def depth(self):
+        return self.shards[0].depth
+
+    @property
+    def statement_timeout(self):
+        return self.shards[0].statement_timeout
+
+    @statement_timeout.setter
+    def statement_timeout(self, seconds):
+        for shard in self.shards:
+            shard.statement_timeout = seconds
+
+    def __enter__(self):
+        cursors = [shard.__enter__() for shard in self.shards]
+        return cursors[0]
+
+    def __exit__(self, obj, exc, tb):
+        for shard in reversed(self.shards):
+            shard.__exit__(obj, exc, tb)
+
+    @contextlib.contextmanager
+    def time_limit(self, seconds):
+        with contextlib.ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.time_limit(seconds))
+            yield
+
+    @contextlib.contextmanager
+    def _apart(self):
+        with contextlib.ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard._apart())
+            yield
+
+    @contextlib.contextmanager
+    def _bulk_load(self, table):
+        with contextlib.ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard._bulk_load(table))
+            yield
+
+    def execute(self, sql, values=(), shard=None):
+        """Runs a statement on the shard at index ``shard`` of ``shards``.
+        Without ``shard``, reads return the rows of every shard, and schema
+        changes are made to every shard. Other statements, which might
+        change rows, need a ``shard``."""
+        if shard is not None:
+            return self.shards[shard].execute(sql, values)
+        self._broadcastable(sql)
+        return self._gathered(shard.execute(sql, values)
+                              for shard in self.shards)
+
+    def executemany(self, sql, values, shard=None):
+        if shard is None:
+            raise ValueError('Statements which change rows need a shard')
+        return self.shards[shard].executemany(sql, values)
+
+    @staticmethod
+    def _broadcastable(sql):
+        words = sql.lstrip().split(None, 1)
+        verb = words[0].upper() if words else ''
+        if verb not in ('SELECT', 'EXPLAIN', 'VALUES', 'PRAGMA', 'CREATE',
+                        'DROP', 'ALTER'):
+            raise ValueError('Statements which change rows need a shard')
+
+    @staticmethod
+    def _gathered(cursors):
+        rows, count = [], 0
+        for cursor in cursors:
+            if cursor.description:
+                rows.extend(cursor.fetchall())
+            count += max(cursor.rowcount, 0)
+        return result(rows, count)
+
+    def retry(self, func, *args, **kwargs):
+        """Calls ``func`` in a transaction on every shard, and again if it
+        raises ``TransientError``, as ``driver_base.retry`` does"""
+        if self.depth:
+            return self._transaction(func, *args, **kwargs)
+        return self.shards[0]._retrying(self._transaction, func, *args,
+                                        **kwargs)
+
+    def _transaction(self, func, *args, **kwargs):
+        with self:
+            return func(*args, **kwargs)
+
+    def clone(self):
+        raise NotImplementedError("Sharded databases can't be cloned")
+
+    def snapshot(self, path=None):
+        raise NotImplementedError("Sharded databases can't be snapshotted")
+
+    def restore(self, snapshot):
+        raise NotImplementedError("Sharded databases can't be snapshotted")
+
+    def _create_aggregate(self, name, source, groupby, sums):
+        raise NotImplementedError(
+            "Aggregate tables aren't supported by sharded databases")
+
+    _rebuild_aggregate = _create_aggregate
+
+    def _create_versioning(self, table, versions):
+        raise NotImplementedError(
+            "Versioned tables aren't supported by sharded databases")
+
+    def _shard_by(self, table, column):
+        self.shard_keys[table] = column
+
+    def _index(self, value):
+        """Index of the shard storing rows whose shard key is ``value``"""
+        return zlib.crc32(str(value).encode('utf-8')) % len(self.shards)
+
+    def _writer(self, table, columns, values):
+        """The shard storing a row with ``values`` of ``columns``"""
+        key = self.shard_keys.get(table)
+        if key is None:
+            return self.shards[0]
+        if key not in columns:
+            raise ValueError('Rows of %s need a value for the shard key %s'
+                             % (table, key))
+        return self.shards[self._index(values[list(columns).index(key)])]
+
+    def _key_values(self, table, conditions):
+        """Values of the shard key of ``table`` which ``conditions``
+        restrict it to, or None if they allow any value"""
+        key = self.shard_keys.get(table)
+        values = None
+        stack = [conditions]
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, list) or len(node) != 3:
+                continue
+            name, a, b = repr(node[0]), node[1], node[2]
+            if name == 'AND':
+                stack.extend((a, b))
+                continue
+            if name == 'EQUAL' and not hasattr(a, 'table'):
+                a, b = b, a
+            if not (hasattr(a, 'table') and a.name == key and
+                    a.table._name == table):
+                continue
+            if name == 'EQUAL' and not hasattr(b, 'table') and \
+                    not isinstance(b, list):
+                found = {b}
+            elif name == 'BELONGS' and isinstance(b, (tuple, list, set)):
+                found = set(b)
+            else:
+                continue
+            values = found if values is None else values & found
+        return values
+
+    def _readers(self, table, conditions):
+        """Shards storing the rows of ``table`` matching ``conditions``"""
+        if table not in self.shard_keys:
+            return self.shards[:1]
+        values = self._key_values(table, conditions)
+        if values is None:
+            return self.shards
+        indexes = sorted(set(map(self._index, values))) or [0]
+        return [self.shards[i] for i in indexes]
+
+    def _insert(self, table, columns, values):
+        return self._writer(table, columns, values)._insert(
+            table, columns, values)
+
+    def _insert_returning(self, table, columns, values, returning):
+        return self._writer(table, columns, values)._insert_returning(
+            table, columns, values, returning)
+
+    def _upsert(self, table, columns, keys, values):
+        return self._writer(table, columns, values)._upsert(
+            table, columns, keys, values)
+
+    def _split(self, table, columns, rows):
+        """Groups ``rows`` by the shard storing them"""
+        shards = collections.OrderedDict()
+        for row in rows:
+            shards.setdefault(self._writer(table, columns, row), []).append(
+                row)
+        return shards.items()
+
+    def _insert_many(self, table, columns, rows):
+        return self._gathered(
+            shard._insert_many(table, columns, rows)
+            for shard, rows in self._split(table, columns, rows))
+
+    def _upsert_many(self, table, columns, keys, rows):
+        return self._gathered(
+            shard._upsert_many(table, columns, keys, rows)
+            for shard, rows in self._split(table, columns, rows))
+
+    def _update(self, table, conditions, values, alias=None):
+        if self.shard_keys.get(alias or table) in values:
+            raise ValueError("Rows can't be moved between shards")
+        return self._gathered(
+            shard._update(table, conditions, values, alias)
+            for shard in self._readers(alias or table, conditions))
+
+    def _delete(self, table, conditions, alias=None):
+        return self._gathered(
+            shard._delete(table, conditions, alias)
+            for shard in self._readers(alias or table, conditions))
+
+    def _open_blob(self, table, column, conditions):
+        shards = self._readers(table, conditions)
+        if len(shards) > 1:
+            raise ValueError('Blobs of %s are read by their shard key'
+                             % table)
+        return shards[0]._open_blob(table, column, conditions)
+
+    def _select_compiled(self, sql, values, args):
+        return self._select(*args)
+
+    def _select(self, columns, tables, conditions, distinct, orderby,
+                groupby=(), having=None, limit=None):
+        shards = []
+        for table in tables:
+            shards.extend(shard for shard in self._readers(
+                table._name, conditions) if shard not in shards)
+        if len(shards) == 1:
+            return shards[0]._select(columns, tables, conditions, distinct,
+                                     orderby, groupby, having, limit)
+        if having is not None:
+            raise NotImplementedError(
+                "Conditions on groups can't be combined across shards")
+        # The values of the ORDER BY and GROUP BY expressions are selected
+        # after the columns, to merge rows with
+        directions = list(map(self._direction, orderby))
+        extra = [e for e, _ in directions] + list(groupby)
+        combine = list(map(self._combiner, list(columns) + extra))
+        grouped = bool(groupby) or any(combine)
+        rows = self._gather(shards, (
+            list(columns) + extra, tables, conditions, distinct, orderby,
+            groupby, None, None if grouped else limit))
+        width = len(columns)
+        keys = slice(width, width + len(directions))
+        descending = [d for _, d in directions]
+
+        def sort_key(row):
+            return order(row[keys], descending)
+        if grouped:
+            merged = self._combine(rows, combine, slice(keys.stop, None))
+            if directions:
+                merged.sort(key=sort_key)
+        elif directions:
+            merged = heapq.merge(*rows, key=sort_key)
+        else:
+            merged = itertools.chain(*rows)
+        merged = (tuple(row[:width]) for row in merged)
+        if distinct:
+            merged = self._unique(merged)
+        return result(itertools.islice(merged, limit))
+
+    @staticmethod
+    def _direction(column):
+        """The expression ``column`` orders by, and whether it's
+        descending"""
+        node = column if hasattr(column, 'table') else getattr(
+            column, '_where_tree', column)
+        if isinstance(node, list) and node and \
+                repr(node[0]) in ('ASCEND', 'DESCEND'):
+            return node[1], repr(node[0]) == 'DESCEND'
+        return column, False
+
+    @classmethod
+    def _combiner(cls, column):
+        """Function combining values of the aggregate ``column`` from two
+        shards, or None if it isn't an aggregate"""
+        node = None if hasattr(column, 'table') else getattr(
+            column, '_where_tree', column)
+        if not isinstance(node, list) or not node:
+            return None
+        name = repr(node[0])
+        if name in combiners and not any(map(cls._aggregated, node[1:])):
+            return combiners[name]
+        if cls._aggregated(node):
+            raise NotImplementedError(
+                "Only COUNT, SUM, MIN and MAX of plain expressions can be"
+                " combined across shards. Select the aggregates by"
+                " themselves and compute with their values instead.")
+        return None
+
+    @classmethod
+    def _aggregated(cls, node):
+        """Whether the expression ``node`` contains an aggregate"""
+        node = None if hasattr(node, 'table') else getattr(
+            node, '_where_tree', node)
+        if not isinstance(node, list) or not node:
+            return False
+        return repr(node[0]) in aggregates or any(
+            map(cls._aggregated, node[1:]))
+
+    @staticmethod
+    def _combine(rows, combine, group):
+        """Merges rows which have the same values of the ``group``
+        columns, combining each column with its function in ``combine``"""
+        groups = collections.OrderedDict()
+        for row in itertools.chain(*rows):
+            key = tuple(row[group])
+            previous = groups.get(key)
+            groups[key] = row if previous is None else tuple(
+                f(a, b) if f else a for f, a, b in zip(combine, previous, row))
+        return list(groups.values())
+
+    @staticmethod
+    def _unique(rows):
+        seen = set()
+        for row in rows:
+            if row not in seen:
+                seen.add(row)
+                yield row
+
+    def _gather(self, shards, args):
+        """The rows selected with ``args`` from each of ``shards``. Shards
+        are read in parallel, each thread on connections of its own, unless
+        a transaction is open, whose changes other connections can't see.
+        Shards which can't open more connections, such as in-memory sqlite
+        databases, are read afterwards on their own connection."""
+        if not self.parallel or any(shard.depth for shard in self.shards):
+            return [shard._select(*args).fetchall() for shard in shards]
+        rows = list(self._pool().map(self._fetch, shards,
+                                     itertools.repeat(args)))
+        return [shard._select(*args).fetchall() if r is None else r
+                for shard, r in zip(shards, rows)]
+
+    def _pool(self):
+        """Threads reading the shards, started by each process"""
+        if self._pid != os.getpid():
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                len(self.shards), thread_name_prefix='sharded')
+            self._clones = threading.local()
+            self._pid = os.getpid()
+        return self._executor
+
+    def _fetch(self, shard, args):
+        clones = self._clones.__dict__.setdefault('clones', {})
+        clone = clones.get(id(shard))
+        if clone is None:
+            try:
+                clone = shard.clone()
+            except (ValueError, NotImplementedError):
+                return None
+            clones[id(shard)] = clone
+        with clone.time_limit(shard._timeout()):
+            return clone._select(*args).fetchall()
+
+
+def _broadcast(name):
+    def method(self, *args, **kwargs):
+        return [getattr(shard, name)(*args, **kwargs)
+                for shard in self.shards][0]
+    method.__name__ = name
+    method.__doc__ = 'Calls ``%s`` of every shard' % name
+    return method
+
+
+# Schema changes are made to every shard
+for _name in ('_create_table_if_nexists', '_create_index', '_rename_table',
+              '_add_column', '_rename_column', '_alter_column',
+              '_rebuild_table', '_drop_column', '_drop_table', 'drop_table',
+              '_create_fulltext', '_drop_fulltext', '_drop_aggregate'):
+    setattr(sharded, _name, _broadcast(_name))
+del _name
@@ -1,17 +1,231 @@
 
 from . import base
 
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import io
+import os
+import queue
+import threading
+import time
 
 import sqlite3
 
 
+class result(object):
+    """Rows and attributes of a cursor, kept after the writer thread has
+    moved on to other statements"""
+    def __init__(self, cursor):
+        self.description = cursor.description
+        self.rows = collections.deque(
+            cursor.fetchall() if cursor.description else ())
+        self.lastrowid = cursor.lastrowid
+        self.rowcount = cursor.rowcount
+
+    def fetchone(self):
+        return self.rows.popleft() if self.rows else None
+
+    def fetchmany(self, size=1):
+        return [self.rows.popleft() for _ in range(min(size, len(self.rows)))]
+
+    def fetchall(self):
+        rows, self.rows = list(self.rows), collections.deque()
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+
+class limited(object):
+    """Cursor whose rows are fetched before its statement's ``deadline``.
+    sqlite runs most of a scan while its rows are fetched, so the statement
+    is interrupted by a progress handler around each fetch, while the rows
+    are still read as they're needed."""
+    def __init__(self, cursor, deadline, handle_exception):
+        self.cursor = cursor
+        self.deadline = deadline
+        self.handle_exception = handle_exception
+        self.description = cursor.description
+        self.lastrowid = cursor.lastrowid
+        self.rowcount = cursor.rowcount
+
+    def _fetch(self, method, *args):
+        connection = self.cursor.connection
+        connection.set_progress_handler(
+            lambda: time.monotonic() > self.deadline, 1000)
+        try:
+            return method(*args)
+        except Exception as e:
+            self.handle_exception(e)
+            raise
+        finally:
+            connection.set_progress_handler(None, 0)
+
+    def fetchone(self):
+        return self._fetch(self.cursor.fetchone)
+
+    def fetchmany(self, size=1):
+        return self._fetch(self.cursor.fetchmany, size)
+
+    def fetchall(self):
+        return self._fetch(self.cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+
+class transaction(object):
+    """Statements of a ``with`` block, which the writer thread runs one
+    after another, inside a savepoint of its own"""
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def submit(self, sql, values, many=False):
+        done = concurrent.futures.Future()
+        self.queue.put((sql, values, many, done))
+        return done.result()
+
+    def end(self, commit):
+        """Waits until the block's writes are committed, or rolls them
+        back"""
+        done = concurrent.futures.Future()
+        self.queue.put((None, commit, False, done))
+        return done.result()
+
+
+class writer(threading.Thread):
+    """Thread which runs every write to a sqlite database on its own
+    connection. Writes queued while a transaction runs are committed
+    together in the next one, each inside a savepoint so that a failing
+    statement doesn't affect the others. The statements of a ``with``
+    block share one savepoint, and other writes wait until it ends."""
+    batch = 100
+
+    def __init__(self, path):
+        threading.Thread.__init__(self, name='sqlite writer', daemon=True)
+        self.path = path
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+
+    def submit(self, sql, values, many=False):
+        done = concurrent.futures.Future()
+        self.queue.put((sql, values, many, done))
+        return done.result()
+
+    def begin(self):
+        block = transaction()
+        self.queue.put(block)
+        return block
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        connection = sqlite3.connect(self.path,
+                                     detect_types=sqlite3.PARSE_DECLTYPES,
+                                     isolation_level=None)
+        connection.execute("""PRAGMA journal_mode=WAL;""")
+        while True:
+            writes = [self.queue.get()]
+            while writes[-1] is not None and len(writes) < self.batch:
+                try:
+                    writes.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = writes[-1] is None
+            if stop:
+                writes.pop()
+            self.write(connection, writes)
+            if stop:
+                connection.close()
+                return
+
+    def write(self, connection, writes):
+        pending = []
+        for write in writes:
+            if isinstance(write, transaction):
+                if not connection.in_transaction:
+                    connection.execute("""BEGIN;""")
+                self.run_block(connection, write, pending)
+                continue
+            sql, values, many, done = write
+            if sql.lstrip().upper().startswith('PRAGMA'):
+                # Some pragmas can't be changed inside a transaction
+                self.commit(connection, pending)
+                pending = []
+            elif not connection.in_transaction:
+                connection.execute("""BEGIN;""")
+            if connection.in_transaction:
+                connection.execute("""SAVEPOINT write;""")
+            try:
+                outcome = self.run_statement(connection, sql, values, many)
+            except Exception as e:
+                outcome = e
+                if connection.in_transaction:
+                    connection.execute("""ROLLBACK TO write;""")
+            if connection.in_transaction:
+                connection.execute("""RELEASE write;""")
+                pending.append((done, outcome))
+            else:
+                self.finish(done, outcome)
+        self.commit(connection, pending)
+
+    @staticmethod
+    def run_statement(connection, sql, values, many):
+        cursor = connection.cursor()
+        if many:
+            cursor.executemany(sql, values)
+        else:
+            cursor.execute(sql, values)
+        return result(cursor)
+
+    def run_block(self, connection, block, pending):
+        connection.execute("""SAVEPOINT block;""")
+        while True:
+            sql, values, many, done = block.queue.get()
+            if sql is None:
+                break
+            try:
+                done.set_result(
+                    self.run_statement(connection, sql, values, many))
+            except Exception as e:
+                done.set_exception(e)
+        if values:
+            connection.execute("""RELEASE block;""")
+            # The block's writes are done once the batch is committed
+            pending.append((done, None))
+        else:
+            connection.execute("""ROLLBACK TO block;""")
+            connection.execute("""RELEASE block;""")
+            done.set_result(None)
+
+    def commit(self, connection, pending):
+        if connection.in_transaction:
+            try:
+                connection.execute("""COMMIT;""")
+            except Exception as e:
+                connection.execute("""ROLLBACK;""")
+                pending = [(done, e) for done, _ in pending]
+        for done, outcome in pending:
+            self.finish(done, outcome)
+
+    @staticmethod
+    def finish(done, outcome):
+        if isinstance(outcome, Exception):
+            done.set_exception(outcome)
+        else:
+            done.set_result(outcome)
+
+
 class sqlite(base.driver_base):
     """Driver for sqlite3 databases
 
-    sqlite accepts only one parameter: path, which is the path of the database
-    file. By default, path=':memory:', which creates a temporary database
-    in memory.
+    sqlite accepts only one required parameter: path, which is the path of
+    the database file. By default, path=':memory:', which creates a
+    temporary database in memory.
 
     The following are equivalent:
 
@@ -20,13 +234,179 @@ class sqlite(base.driver_base):
     >>> mydb = DB.connect('sqlite')
 
     >>> mydb = DB.connect('sqlite', ':memory:')
+
+    With ``single_writer=True``, statements which write to the database are
+    queued for a single thread with its own connection, which commits
+    queued writes together, and the database is switched to write-ahead
+    logging. Each thread reads on a connection of its own. This avoids
+    "database is locked" errors when many threads write to a database file.
+    The statements of a ``with`` block are run by the writer thread, as one
+    transaction, while other threads' writes wait for the block to end.
+    ``close`` stops the writer thread.
     """
     id_quote = '"'
+    _writer = None
 
-    def __init__(self, path=':memory:', debug=False):
+    def __init__(self, path=':memory:', debug=False, single_writer=False):
         self.path = path
         self.__db_api_init__(sqlite3, path, sqlite3.PARSE_DECLTYPES,
                              debug=debug)
+        if sqlite3.sqlite_version_info >= (3, 35):
+            self.features.add('returning')
+        if sqlite3.sqlite_version_info >= (3, 32):
+            self.max_parameters = 32766
+        if single_writer and path == ':memory:':
+            raise ValueError('In-memory databases can not be shared between'
+                             ' connections')
+        self.single_writer = single_writer
+        self._lock = threading.Lock()
+
+    def clone(self):
+        if self.path == ':memory:':
+            raise ValueError('In-memory databases can not be shared between'
+                             ' connections')
+        other = base.driver_base.clone(self)
+        # Clones read and write on their own connection
+        other.single_writer = False
+        return other
+
+    _unpickled = base.driver_base._unpickled + ('_lock', '_writer',
+                                                 '_threads')
+
+    def __getstate__(self):
+        if self.path == ':memory:':
+            raise ValueError('In-memory databases can not be shared between'
+                             ' connections')
+        state = base.driver_base.__getstate__(self)
+        # Like clones, copies read and write on their own connection
+        state['single_writer'] = False
+        return state
+
+    def __setstate__(self, state):
+        base.driver_base.__setstate__(self, state)
+        self._lock = threading.Lock()
+
+    def _forked(self):
+        # A child's copy of an in-memory database is its own to keep using
+        if self.path == ':memory:':
+            self.connection = self._connection
+            self.depth = 0
+            self.cursor = None
+        else:
+            base.driver_base._forked(self)
+
+    def _writes(self):
+        """The writer thread of the current process, started on first use"""
+        writer_ = self._writer
+        if writer_ is None or writer_.pid != os.getpid():
+            with self._lock:
+                if self._writer is writer_:
+                    self._threads = threading.local()
+                    self._writer = writer(self.path)
+                    self._writer.start()
+        return self._writer
+
+    def close(self):
+        """Closes the database's connections. In ``single_writer`` mode,
+        waits for queued writes and stops the writer thread."""
+        with self._lock:
+            writer_, self._writer = self._writer, None
+        if writer_ is not None and writer_.pid == os.getpid():
+            writer_.stop()
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+            self._connection = None
+
+    @staticmethod
+    def _is_read(sql):
+        words = sql.lstrip().split(None, 1)
+        verb = words[0].upper() if words else ''
+        return verb in ('SELECT', 'EXPLAIN') or (
+            verb == 'PRAGMA' and '=' not in sql)
+
+    def _reader(self):
+        connection = getattr(self._threads, 'connection', None)
+        if connection is None:
+            connection = self._threads.connection = sqlite3.connect(
+                self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+        return connection
+
+    def _block(self):
+        """The ``with`` block the current thread is in, in single_writer
+        mode"""
+        self._writes()
+        return getattr(self._threads, 'block', None)
+
+    def __enter__(self):
+        if not self.single_writer:
+            return base.driver_base.__enter__(self)
+        if self._block() is None:
+            self._threads.block = self._writes().begin()
+            self._threads.depth = 0
+        self._threads.depth += 1
+
+    def __exit__(self, obj, exc, tb):
+        if not self.single_writer:
+            return base.driver_base.__exit__(self, obj, exc, tb)
+        self._threads.depth -= 1
+        if self._threads.depth == 0:
+            block, self._threads.block = self._threads.block, None
+            try:
+                block.end(commit=obj is None)
+            except Exception as e:
+                self.handle_exception(e)
+                raise
+
+    def retry(self, func, *args, **kwargs):
+        if not self.single_writer:
+            return base.driver_base.retry(self, func, *args, **kwargs)
+        if self._block() is not None:
+            return self._transaction(func, *args, **kwargs)
+        return self._retrying(self._transaction, func, *args, **kwargs)
+
+    def execute(self, sql, values=()):
+        if not self.single_writer:
+            return base.driver_base.execute(self, sql, values)
+        self.lastsql = sql
+        block = self._block()
+        if block is not None:
+            # Reads in a block see its writes
+            return self._submit(block.submit, sql, values)
+        if self._is_read(sql):
+            return self._retrying(self._read, sql, values)
+        return self._retrying(self._submit, self._writes().submit, sql,
+                              values)
+
+    def executemany(self, sql, values):
+        if not self.single_writer:
+            return base.driver_base.executemany(self, sql, values)
+        self.lastsql = sql
+        values = list(values)
+        block = self._block()
+        if block is not None:
+            return self._submit(block.submit, sql, values, True)
+        return self._retrying(self._submit, self._writes().submit, sql,
+                              values, True)
+
+    def _submit(self, submit, sql, values, many=False):
+        try:
+            return submit(sql, values, many)
+        except Exception as e:
+            self.handle_exception(e)
+            raise Exception(e, sql, values)
+
+    def _read(self, sql, values):
+        try:
+            reader = self._reader()
+            seconds = self._timeout()
+            with self._interrupt_after(reader, seconds) as deadline:
+                cursor = reader.execute(sql, values)
+                if seconds is not None:
+                    return self._buffered(cursor, deadline)
+                return cursor
+        except Exception as e:
+            self.handle_exception(e)
+            raise Exception(e, sql, values)
 
     def normalize_column(self, column):
         r = base.driver_base.normalize_column(self, column)
@@ -58,6 +438,12 @@ class sqlite(base.driver_base):
                     msg.startswith('no such column: ')):
                 raise KeyError(
                     "No such column in table: %s" % msg.rsplit(None, 1)[1])
+            if msg == 'interrupted':
+                raise base.StatementTimeout(
+                    'Statement took too long: %s' % self.lastsql)
+            if msg in ('database is locked', 'database table is locked',
+                       'database is busy'):
+                raise base.TransientError(msg)
             if msg == 'unable to open database file':
                 raise base.make_IOError(
                     'ENOENT', 'No such file or directory: %r' % self.path)
@@ -70,8 +456,23 @@ class sqlite(base.driver_base):
             if msg.startswith('UNIQUE constraint failed: '):
                 raise ValueError(msg)
 
+    # Tables FTS5 keeps for each full-text table, named after it
+    fts5_shadows = ('data', 'idx', 'content', 'docsize', 'config')
+
     def list_tables_sql(self):
-        return """SELECT name FROM sqlite_master WHERE type='table'"""
+        # Full-text indexes are FTS5 tables named "<table>_fts", which
+        # aren't listed, nor are their shadow tables
+        return """SELECT name FROM sqlite_master AS m WHERE type='table'
+            AND NOT EXISTS (
+                SELECT 1 FROM sqlite_master AS v
+                WHERE v.type='table' AND v.sql LIKE 'CREATE VIRTUAL TABLE%%'
+                AND v.sql LIKE '%% USING fts5(%%'
+                AND v.name LIKE '%%!_fts' ESCAPE '!'
+                AND EXISTS (SELECT 1 FROM sqlite_master AS t
+                            WHERE t.type='table'
+                            AND t.name = substr(v.name, 1, length(v.name) - 4))
+                AND m.name IN (v.name, %s))""" % ', '.join(
+            "v.name || '_%s'" % suffix for suffix in self.fts5_shadows)
 
     def list_columns(self, table):
         for _, name, v_type, notnull, default, _ in self.execute(
@@ -85,5 +486,217 @@ class sqlite(base.driver_base):
                     '%s ASC' % p for p in primarykeys))
                 if primarykeys else ''))
 
+    def list_indexes(self, table):
+        for _, name, unique, _, _ in self.execute(
+                """PRAGMA index_list(%s);""" % table).fetchall():
+            yield (str(name), bool(unique), [
+                str(column) for _, _, column in self.execute(
+                    """PRAGMA index_info(%s);""" % self.identifier(name))])
+
+    def create_index_if_nexists_sql(self, table, name, columns, unique):
+        return """CREATE%s INDEX IF NOT EXISTS %s ON %s(%s);""" % (
+            ' UNIQUE' if unique else '', name, table, ', '.join(columns))
+
+    def _create_fulltext(self, table, columns, reindex=False):
+        """Indexes ``columns`` in an FTS5 table named ``<table>_fts``, which
+        reads text from ``table`` and is kept up to date by triggers. The
+        update trigger only fires when indexed columns change."""
+        fts = '%s_fts' % table
+        new = self.execute(
+            """SELECT 1 FROM sqlite_master WHERE name=?;""", [fts]
+        ).fetchone() is None
+        names = ', '.join(map(self.identifier, columns))
+        delete_sql = """INSERT INTO %s(%s, rowid, %s) VALUES ('delete',
+            old.rowid, %s);""" % (
+            self.identifier(fts), self.identifier(fts), names,
+            ', '.join('old.%s' % self.identifier(c) for c in columns))
+        insert_sql = """INSERT INTO %s(rowid, %s) VALUES (new.rowid, %s);
+            """ % (self.identifier(fts), names,
+                   ', '.join('new.%s' % self.identifier(c) for c in columns))
+        self.execute(
+            """CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s,
+               content=%s);""" % (
+                self.identifier(fts), names, self.literal(table)))
+        for event, body in (('INSERT', insert_sql),
+                            ('DELETE', delete_sql),
+                            ('UPDATE OF %s' % names, delete_sql + insert_sql)):
+            self.execute(
+                """CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON %s
+                   BEGIN %s END;""" % (
+                    self.identifier('%s_%s' % (fts, event.split()[0].lower())),
+                    event, self.identifier(table), body))
+        if new or reindex:
+            self.execute("""INSERT INTO %s(%s) VALUES ('rebuild');""" % (
+                self.identifier(fts), self.identifier(fts)))
+
+    def _drop_fulltext(self, table):
+        self.execute("""DROP TABLE IF EXISTS %s;""" % (
+            self.identifier('%s_fts' % table)))
+
+    def _fulltext_refs(self, column):
+        """Splits a formatted column into its table, and the full-text
+        table and column which index it"""
+        table, name = column.split('.')
+        fts = self.identifier('%s_fts' % table.strip(self.id_quote))
+        return table, fts, '%s.%s' % (fts, name)
+
+    def op_MATCH(self, column, query):
+        table, fts, indexed = self._fulltext_refs(column)
+        return '%s.rowid IN (SELECT rowid FROM %s WHERE %s MATCH %s)' % (
+            table, fts, indexed, query)
+
+    def op_RELEVANCE(self, column, query):
+        # bm25 is lower for better matches
+        table, fts, indexed = self._fulltext_refs(column)
+        return ('(SELECT -bm25(%s) FROM %s WHERE %s MATCH %s'
+                ' AND rowid = %s.rowid)' % (fts, fts, indexed, query, table))
+
+    def _buffered(self, cursor, deadline):
+        return limited(cursor, deadline, self.handle_exception)
+
+    @contextlib.contextmanager
+    def _interrupt_after(self, connection, seconds):
+        if seconds is None:
+            yield
+            return
+        deadline = time.monotonic() + seconds
+        # sqlite calls the handler every 1000 virtual machine instructions,
+        # and interrupts the statement once it returns True
+        connection.set_progress_handler(
+            lambda: time.monotonic() > deadline, 1000)
+        try:
+            yield deadline
+        finally:
+            connection.set_progress_handler(None, 0)
+
+    def _open_blob(self, table, column, conditions):
+        # Connection.blobopen is new in Python 3.11
+        if self.single_writer or not hasattr(self.connection, 'blobopen'):
+            return base.driver_base._open_blob(self, table, column,
+                                               conditions)
+        row = self.execute("""SELECT _rowid_ FROM %s%s;""" % (
+            self.identifier(table), self.where_clause(conditions))).fetchone()
+        if row is None:
+            return io.BytesIO()
+        return self.connection.blobopen(table, column, row[0], readonly=True)
+
+    def snapshot(self, path=None):
+        """Copies the database into a new in-memory connection, or into the
+        file at ``path``, using sqlite's backup API"""
+        target = sqlite3.connect(path or ':memory:',
+                                 detect_types=sqlite3.PARSE_DECLTYPES)
+        self.connection.backup(target)
+        if path is not None:
+            target.close()
+            return path
+        return target
+
+    def restore(self, snapshot):
+        """Replaces the database with a copy of ``snapshot``, which is a
+        connection returned by ``snapshot`` or the path of a database file"""
+        close = isinstance(snapshot, str)
+        if close:
+            snapshot = sqlite3.connect(snapshot)
+        try:
+            snapshot.backup(self.connection)
+        finally:
+            if close:
+                snapshot.close()
+
+    @contextlib.contextmanager
+    def _bulk_load(self, table):
+        """Drops the table's plain indexes and stops waiting for writes to
+        reach the disk while loading, restoring both afterwards"""
+        indexes = self.execute(
+            """SELECT name, sql FROM sqlite_master WHERE type='index' AND"""
+            """ tbl_name=? AND sql IS NOT NULL;""", (table,)).fetchall()
+        indexes = [(name, sql) for name, sql in indexes
+                   if not sql.upper().startswith('CREATE UNIQUE')]
+        synchronous, = self.execute("""PRAGMA synchronous;""").fetchone()
+        for name, _ in indexes:
+            self.execute("""DROP INDEX %s;""" % self.identifier(name))
+        self.execute("""PRAGMA synchronous=OFF;""")
+        try:
+            yield
+        finally:
+            self.execute("""PRAGMA synchronous=%i;""" % synchronous)
+            for _, sql in indexes:
+                self.execute(sql)
+
+    def _rebuild_table(self, table, columns, primarykeys, copied, chunk):
+        """sqlite can't alter or drop columns, so the new definition is
+        created under a temporary name and rows are copied over ``chunk`` at
+        a time, in order of rowid. Each chunk is committed separately, so the
+        write lock is only held briefly. Meanwhile, triggers log the rows
+        which are inserted, updated or deleted. The last chunk is copied in
+        the same transaction that copies logged rows again and replaces the
+        original table, so no changes are lost. If anything fails, the
+        triggers and temporary tables are dropped again."""
+        temp = '%s__rebuild' % table
+        log = '%s__rebuild_log' % table
+        self.execute(
+            """DROP TABLE IF EXISTS %s;""" % self.identifier(temp))
+        self.execute(
+            """DROP TABLE IF EXISTS %s;""" % self.identifier(log))
+        triggers = [self.identifier('%s_%s' % (log, event))
+                    for event in ('insert', 'delete', 'update')]
+        try:
+            self._rebuild_rows(table, temp, log, triggers, columns,
+                               primarykeys, copied, chunk)
+        except Exception:
+            for trigger in triggers:
+                self.execute(self.drop_trigger_sql(trigger))
+            for name in (temp, log):
+                self.execute(
+                    """DROP TABLE IF EXISTS %s;""" % self.identifier(name))
+            raise
+
+    def _rebuild_rows(self, table, temp, log, triggers, columns,
+                      primarykeys, copied, chunk):
+        self._create_table_if_nexists(temp, columns, primarykeys)
+        # Rows keep their rowid, unless the new table's rowid is an
+        # INTEGER PRIMARY KEY copied from the old table, which sets it
+        if (len(primarykeys) == 1 and primarykeys[0] in copied and
+                columns[primarykeys[0]]._storage_type is int):
+            key, names = self.identifier(primarykeys[0]), []
+        else:
+            key, names = '_rowid_', ['_rowid_']
+        names = ', '.join(names + list(map(self.identifier, copied)))
+        self.execute("""CREATE TABLE %s(key);""" % self.identifier(log))
+        for trigger, event, rows in zip(
+                triggers, ('INSERT', 'DELETE', 'UPDATE'),
+                (['new'], ['old'], ['old', 'new'])):
+            self.execute(self.drop_trigger_sql(trigger))
+            self.execute(self.create_trigger_sql(
+                trigger, event, self.identifier(table), ' '.join(
+                    """INSERT INTO %s VALUES (%s.%s);""" % (
+                        self.identifier(log), row, key) for row in rows)))
+        table, temp = self.identifier(table), self.identifier(temp)
+        log = self.identifier(log)
+        copy_sql = """INSERT INTO %s(%s) SELECT %s FROM %s%%s;""" % (
+            temp, names, names, table)
+        after = ''
+        while True:
+            bound = self.execute(
+                """SELECT _rowid_ FROM %s%s ORDER BY _rowid_ LIMIT 1
+                   OFFSET %i;""" % (table, after, chunk - 1)).fetchone()
+            if bound is None:
+                break
+            with self:
+                self.execute(copy_sql % (
+                    (after + ' AND' if after else ' WHERE') +
+                    ' _rowid_<=%i' % bound[0]))
+            after = ' WHERE _rowid_>%i' % bound[0]
+        with self:
+            if after:
+                # Rows changed since they were copied are copied again
+                self.execute("""DELETE FROM %s WHERE _rowid_ IN (
+                    SELECT key FROM %s);""" % (temp, log))
+                after += ' OR %s IN (SELECT key FROM %s)' % (key, log)
+            self.execute(copy_sql % after)
+            self.drop_table(table)
+            self.drop_table(log)
+            self.rename_table(temp, table)
+
     def _drop_column(self, table, column):
         raise NotImplementedError